@@ -0,0 +1,775 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Headless optimisation of one day, run in a new python process.
+# Prints the time to import the modules and the time of the first optimisation as json.
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+
+import json
+import numpy as np
+from market import Market, PumpStoragePlantIRMarketOptimiserNDays
+from optimize_dynamic import DynamicProgrammingOptimisation
+from powerplant import PumpStoragePlant
+
+imported = time.perf_counter()
+
+ppt = PumpStoragePlant(100, 100, 600, 0.75)
+market_optimiser = PumpStoragePlantIRMarketOptimiserNDays(ppt, Market(), DynamicProgrammingOptimisation(ppt))
+market_optimiser.timehorizon = 2
+prices = np.random.default_rng(0).normal(50, 20, (2, 96))
+market_optimiser.set_prices(prices[:, ::4], prices, prices)
+market_optimiser.optimise()
+
+optimised = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_optimisation': optimised - imported}))
+"""
+
+
+def run_startup_script(numba_cache_dir):
+    env = dict(os.environ, NUMBA_CACHE_DIR=numba_cache_dir)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env=env, capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    total = time.perf_counter() - start
+
+    result = json.loads(output.strip().splitlines()[-1])
+    result['total'] = total
+    return result
+
+
+def benchmark_startup(repeat=3):
+    """
+    Measure the startup time of a headless optimisation in new processes.
+    Cold start: the numba cache is empty, all the functions are compiled.
+    Warm start: the compiled functions are loaded from the numba cache.
+
+    Returns
+    -------
+    dict with the cold start times and the warm start times of each repetition
+    """
+    with tempfile.TemporaryDirectory() as numba_cache_dir:
+        cold = run_startup_script(numba_cache_dir)
+        warm = [run_startup_script(numba_cache_dir) for i in range(repeat)]
+    return {'cold': cold, 'warm': warm}
+
+
+def print_startup_benchmark(results):
+    print("########## Startup time ##########")
+    print("%-10s %10s %20s %10s" % ("", "import", "first optimisation", "total"))
+    rows = [("cold", results['cold'])] + [("warm %i" % i, r) for i, r in enumerate(results['warm'])]
+    for name, r in rows:
+        print("%-10s %9.3fs %19.3fs %9.3fs" % (name, r['import'], r['first_optimisation'], r['total']))
+
+
+def get_random_prices(n_steps, seed=0):
+    return np.random.default_rng(seed).normal(50, 20, n_steps)
+
+
+def benchmark_multigrid(ppt, factors, n_days=7, repeat=3):
+    """
+    Compare the exact and the multigrid optimisation of an intraday window (one day of quarter hours
+        followed by n_days - 1 days of hours) with the given power plant.
+
+    Returns
+    -------
+    dict with the time of the exact optimisation, and the time and profit gap for each multigrid factor
+    """
+    from optimize_dynamic import DynamicProgrammingOptimisation
+
+    prices = get_random_prices(96 + (n_days - 1) * 24)
+    step_durations = np.concatenate((np.ones(96) * 0.25, np.ones((n_days - 1) * 24)))
+    level = ppt.get_max_level() / 2
+
+    def measure(optimiser):
+        # First call compiles the numba functions
+        optimiser.calculate_optimal_schedule(prices, level, 0, level, step_durations)
+        start = time.perf_counter()
+        for i in range(repeat):
+            optimiser.calculate_optimal_schedule(prices, level, 0, level, step_durations)
+        return (time.perf_counter() - start) / repeat
+
+    results = {'exact': measure(DynamicProgrammingOptimisation(ppt)), 'multigrid': {}}
+    for factor in factors:
+        optimiser = DynamicProgrammingOptimisation(ppt, multigrid_factor=factor)
+        gap = optimiser.get_multigrid_profit_gap(prices, level, 0, level, step_durations)
+        results['multigrid'][factor] = {'time': measure(optimiser), 'relative_profit_gap': gap['relative_profit_gap']}
+    return results
+
+
+def print_multigrid_benchmark(name, results):
+    print("########## Multigrid %s ##########" % name)
+    print("exact: %.4fs" % results['exact'])
+    for factor, r in results['multigrid'].items():
+        print("factor %3i: %.4fs (x%.1f) profit gap %.4f%%" % (factor, r['time'], results['exact'] / r['time'],
+                                                              r['relative_profit_gap'] * 100))
+
+
+def benchmark_kernel_threads(ppt, thread_counts=None, n_days=7, repeat=3):
+    """
+    Time of the scatter kernel with float64 and float32 profits and of the gather kernel with different numbers
+        of threads, for an intraday window of n_days days.
+
+    Returns
+    -------
+    dict with the times of the scatter kernel and the time of the gather kernel for each number of threads
+    """
+    import numba
+    from optimize_dynamic import DynamicProgrammingOptimisation
+
+    if (thread_counts is None):
+        thread_counts = sorted({1, 2, 4, 8, 16, 32, numba.config.NUMBA_NUM_THREADS})
+    thread_counts = [n for n in thread_counts if n <= numba.config.NUMBA_NUM_THREADS]
+
+    prices = get_random_prices(96 + (n_days - 1) * 24)
+    step_durations = np.concatenate((np.ones(96) * 0.25, np.ones((n_days - 1) * 24)))
+
+    def measure(optimiser):
+        final_level = optimiser.n_energy_levels // 2
+        optimiser.build_matrix(prices, optimiser.n_energy_levels, 0, final_level, step_durations)
+        start = time.perf_counter()
+        for i in range(repeat):
+            optimiser.build_matrix(prices, optimiser.n_energy_levels, 0, final_level, step_durations)
+        return (time.perf_counter() - start) / repeat
+
+    results = {'n_energy_levels': DynamicProgrammingOptimisation(ppt).n_energy_levels,
+               'scatter': measure(DynamicProgrammingOptimisation(ppt)),
+               'scatter_float32': measure(DynamicProgrammingOptimisation(ppt, reachability_pruning=False,
+                                                                         value_dtype=np.float32)),
+               'gather': {}}
+    default_thread_count = numba.get_num_threads()
+    try:
+        for n in thread_counts:
+            numba.set_num_threads(n)
+            results['gather'][n] = measure(DynamicProgrammingOptimisation(ppt, kernel="gather"))
+    finally:
+        numba.set_num_threads(default_thread_count)
+    return results
+
+
+def print_kernel_threads_benchmark(name, results):
+    print("########## Kernel thread scaling %s (%i energy levels) ##########" % (name, results['n_energy_levels']))
+    print("scatter:            %.4fs" % results['scatter'])
+    print("scatter float32:    %.4fs" % results['scatter_float32'])
+    for n, duration in results['gather'].items():
+        print("gather %3i threads: %.4fs (x%.1f)" % (n, duration, results['scatter'] / duration))
+
+
+def benchmark_reachability_pruning(ppt, n_steps_list=(4, 16, 96, 672), repeat=3):
+    """
+    Compare the optimisation of quarter hour windows of n_steps time steps, starting and ending in the middle
+        of the reservoir, with and without the reachability pruning of the energy levels.
+
+    Returns
+    -------
+    dict with the time with and without pruning for each number of time steps
+    """
+    from optimize_dynamic import DynamicProgrammingOptimisation
+
+    level = ppt.get_max_level() / 2
+    optimisers = {'full': DynamicProgrammingOptimisation(ppt, reachability_pruning=False),
+                  'pruned': DynamicProgrammingOptimisation(ppt)}
+    results = {'n_energy_levels': optimisers['full'].n_energy_levels}
+    for n_steps in n_steps_list:
+        prices = get_random_prices(n_steps)
+        step_durations = np.ones(n_steps) * 0.25
+        results[n_steps] = {name: get_best_time(lambda: optimiser.calculate_optimal_schedule(prices, level, 0, level,
+                                                                                             step_durations),
+                                                repeat)
+                            for name, optimiser in optimisers.items()}
+    return results
+
+
+def print_reachability_pruning_benchmark(name, results):
+    print("########## Reachability pruning %s (%i energy levels) ##########" % (name, results['n_energy_levels']))
+    for n_steps, r in results.items():
+        if (n_steps != 'n_energy_levels'):
+            print("%4i steps: full %.4fs, pruned %.4fs (x%.1f)" % (n_steps, r['full'], r['pruned'],
+                                                                  r['full'] / r['pruned']))
+
+
+def benchmark_checkpointed_backtracking(ppt, n_days=31, repeat=1):
+    """
+    Compare the optimisation of a window of n_days days of quarter hours with the full decision matrix
+        and with the checkpointed backtracking (decision_memory_budget=0).
+    The peak memory is the one of the allocations made during the optimisation, measured with tracemalloc.
+
+    Returns
+    -------
+    dict with the time, the peak memory in bytes and the estimated memory of each mode
+    """
+    import tracemalloc
+    from optimize_dynamic import DynamicProgrammingOptimisation
+
+    n_steps = n_days * 96
+    prices = get_random_prices(n_steps)
+    step_durations = np.ones(n_steps) * 0.25
+    level = ppt.get_max_level() / 2
+
+    results = {}
+    for name, budget in (('matrix', None), ('checkpointed', 0)):
+        optimiser = DynamicProgrammingOptimisation(ppt, reachability_pruning=False, decision_memory_budget=budget)
+        duration = get_best_time(lambda: optimiser.calculate_optimal_schedule(prices, level, 0, level, step_durations),
+                                 repeat)
+        tracemalloc.start()
+        optimiser.calculate_optimal_schedule(prices, level, 0, level, step_durations)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if (budget is None):
+            estimated_memory = optimiser.get_decision_matrix_size(n_steps)
+        else:
+            estimated_memory = optimiser.get_checkpointed_memory_size(n_steps)
+        results[name] = {'time': duration, 'peak_memory': peak_memory, 'estimated_memory': estimated_memory}
+    return results
+
+
+def print_checkpointed_backtracking_benchmark(name, results):
+    print("########## Checkpointed backtracking %s ##########" % name)
+    for mode, r in results.items():
+        print("%-12s: %.3fs, peak memory %.1f MB (estimated %.1f MB)" % (mode, r['time'], r['peak_memory'] / 1e6,
+                                                                        r['estimated_memory'] / 1e6))
+
+
+def get_optimiser_modes():
+    """
+    Options of DynamicProgrammingOptimisation compared with the reference (no reachability pruning, no memory budget).
+    (name, options, exact): exact tells if the schedule must be the same, else only the profit is compared.
+    """
+    reference = {'reachability_pruning': False, 'decision_memory_budget': None}
+    return [("reachability_pruning", {}, True),
+            ("checkpointed", dict(reference, decision_memory_budget=0), True),
+            ("checkpointed_pruning", {'decision_memory_budget': 0}, True),
+            ("packed", dict(reference, packed_decisions=True), True),
+            ("gather", dict(reference, kernel="gather"), True),
+            ("float32", dict(reference, value_dtype=np.float32), False)]
+
+
+def check_optimiser_modes(ppt, n_windows=20, seed=0, tolerance=1e-6):
+    """
+    Compare the options of get_optimiser_modes with the reference optimisation on random windows:
+        calculate_optimal_schedule from a random energy level, and calculate_optimal_schedule_with_tail
+        with a tail from calculate_tail, which keeps all the energy levels at its start (initial level -1).
+    The exact modes must give the same profit and schedule, float32 the same profit within tolerance
+        of the largest absolute profit.
+
+    Returns
+    -------
+    dict with the number of windows compared and the list of the differences (mode, window, case)
+    """
+    from optimize_dynamic import DynamicProgrammingOptimisation
+
+    rng = np.random.default_rng(seed)
+    reference = DynamicProgrammingOptimisation(ppt, reachability_pruning=False, decision_memory_budget=None)
+    optimisers = [(name, DynamicProgrammingOptimisation(ppt, **options), exact)
+                  for name, options, exact in get_optimiser_modes()]
+    step = reference.energy_lvl_step
+    keys = ('total_cashflow', 'sell_mwh', 'buy_mwh', 'hourly_energy_level')
+
+    differences = []
+    n_compared = 0
+    for window in range(n_windows):
+        n_head = int(rng.integers(1, 97))
+        n_tail = int(rng.integers(1, 49))
+        prices = rng.normal(50, 20, n_head + n_tail)
+        step_durations = rng.choice([0.25, 1.0], n_head + n_tail)
+        initial_level = int(rng.integers(0, reference.n_energy_levels)) * step
+        # Every second window ends at its initial energy level, always reachable on big reservoirs
+        final_level = int(rng.integers(0, reference.n_energy_levels)) * step if (window % 2) else initial_level
+        previous_last_action = int(rng.integers(-1, 2))
+
+        def solve(optimiser):
+            tail = optimiser.calculate_tail(prices[n_head:], final_level, step_durations[n_head:])
+            return {'schedule': optimiser.calculate_optimal_schedule(prices, initial_level, previous_last_action,
+                                                                     final_level, step_durations),
+                    'with_tail': optimiser.calculate_optimal_schedule_with_tail(prices[:n_head], initial_level,
+                                                                                previous_last_action, tail,
+                                                                                step_durations[:n_head])}
+
+        expected = solve(reference)
+        if (not np.isfinite(expected['schedule']['total_cashflow'])):
+            # The final energy level can not be reached from the initial energy level
+            continue
+        n_compared += 1
+        for name, optimiser, exact in optimisers:
+            for case, results in solve(optimiser).items():
+                if (exact):
+                    same = all(np.array_equal(results[key], expected[case][key]) for key in keys)
+                else:
+                    same = abs(results['total_cashflow'] - expected[case]['total_cashflow']) <= tolerance * max(
+                        1.0, abs(expected[case]['total_cashflow']))
+                if (not same):
+                    differences.append((name, window, case))
+    return {'n_windows': n_compared, 'differences': differences}
+
+
+def print_optimiser_modes_check(name, results):
+    print("########## Optimiser modes %s (%i windows) ##########" % (name, results['n_windows']))
+    if (len(results['differences']) == 0):
+        print("all modes give the reference results")
+    for mode, window, case in results['differences']:
+        print("%s differs from the reference on window %i (%s)" % (mode, window, case))
+
+
+def check_checkpoint_resume(max_days=None, n_days=14, interrupted_day=10, checkpoint_interval=3):
+    """
+    Interrupt a rolling optimisation at interrupted_day, resume it from its checkpoint and compare the history
+        of the power plant state and of the market with an optimisation without interruption.
+    max_days limits the history of the power plant state and of the market, see PumpStoragePlantState.
+
+    Returns
+    -------
+    True if the resumed optimisation gives the same history
+    """
+    from market import Market, PumpStoragePlantIRMarketOptimiserNDays
+    from optimize_dynamic import DynamicProgrammingOptimisation
+    from powerplant import PumpStoragePlant, PumpStoragePlantState
+
+    prices = get_random_prices(n_days * 96).reshape(n_days, 96)
+
+    def create_market_optimiser():
+        ppt = PumpStoragePlant(100, 100, 600, 0.75)
+        ppt.state = PumpStoragePlantState(ppt, max_days)
+        market = Market()
+        market.clear(max_days)
+        market_optimiser = PumpStoragePlantIRMarketOptimiserNDays(ppt, market, DynamicProgrammingOptimisation(ppt))
+        market_optimiser.set_prices(prices[:, ::4], prices, prices)
+        return market_optimiser
+
+    def get_history(market_optimiser):
+        state = market_optimiser.ppt.state
+        market = market_optimiser.market
+        return [state.executed_schedule, state.cashflow_schedule, state.prices, market.ledger_da.history,
+                market.ledger_id_1.history, market.ledger_id_2.history]
+
+    expected = create_market_optimiser()
+    expected.optimise()
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint_path = os.path.join(directory, "checkpoint.npz")
+        interrupted = create_market_optimiser()
+        optimise_day = interrupted.optimise_day
+
+        def optimise_day_until_interrupted(i, day_id=None):
+            if (i == interrupted_day):
+                raise KeyboardInterrupt
+            optimise_day(i, day_id)
+
+        interrupted.optimise_day = optimise_day_until_interrupted
+        try:
+            interrupted.optimise(checkpoint_path, checkpoint_interval)
+        except KeyboardInterrupt:
+            pass
+        resumed = create_market_optimiser()
+        resumed.resume(checkpoint_path, checkpoint_interval)
+
+    return all(np.array_equal(a, b) for a, b in zip(get_history(expected), get_history(resumed)))
+
+
+def run_check_command(n_windows=20):
+    """
+    Check the optimiser modes on the plants of the benchmark suite,
+        and the resume of an interrupted optimisation with and without a limit of the history.
+
+    Returns
+    -------
+    1 if a mode differs from the reference, else 0
+    """
+    failed = False
+    for name, ppt in get_suite_plants():
+        results = check_optimiser_modes(ppt, n_windows)
+        print_optimiser_modes_check(name, results)
+        failed |= len(results['differences']) > 0
+
+    for max_days in (None, 3):
+        same = check_checkpoint_resume(max_days)
+        print("########## Checkpoint resume (max_days %s) ##########" % max_days)
+        print("same history as without interruption" if same else "the resumed history differs")
+        failed |= not same
+    return 1 if failed else 0
+
+
+def benchmark_tail_aggregation(aggregations, timehorizons, n_days=60, create_power_plant=None):
+    """
+    Compare the rolling optimisation of n_days days of price.mat with all the hours of the time horizon and
+        with the tail aggregations (see PumpStoragePlantIRMarketOptimiserNDays.tail_aggregation).
+    The power plant is created with create_power_plant, the plant of power-plant-informations.xlsx if None.
+
+    Returns
+    -------
+    dict with for each time horizon the time and total value of each aggregation ('full' for all the hours)
+        and the relative loss of total value compared to all the hours
+    """
+    from input import get_price_data_memmap, read_power_plant_informations
+    from market import Market, PumpStoragePlantIRMarketOptimiserNDays
+    from optimize_dynamic import DynamicProgrammingOptimisation
+
+    prices = [price[0:n_days] for price in get_price_data_memmap()]
+    if (create_power_plant is None):
+        create_power_plant = read_power_plant_informations
+
+    def optimise(timehorizon, tail_aggregation):
+        ppt = create_power_plant()
+        market = Market()
+        market_optimiser = PumpStoragePlantIRMarketOptimiserNDays(ppt, market, DynamicProgrammingOptimisation(ppt))
+        market_optimiser.timehorizon = timehorizon
+        market_optimiser.tail_aggregation = tail_aggregation
+        market_optimiser.set_prices(*prices)
+        start = time.perf_counter()
+        market_optimiser.optimise()
+        duration = time.perf_counter() - start
+        return {'time': duration, 'total_value': market.rolling_da_id_1 + market.rolling_id_1_id_2 + market.rollging_id_2_da}
+
+    results = {}
+    for timehorizon in timehorizons:
+        full = optimise(timehorizon, None)
+        results[timehorizon] = {'full': full}
+        for aggregation in aggregations:
+            result = optimise(timehorizon, aggregation)
+            result['relative_loss'] = (full['total_value'] - result['total_value']) / abs(full['total_value'])
+            results[timehorizon][str(aggregation)] = result
+    return results
+
+
+def print_tail_aggregation_benchmark(results):
+    print("########## Tail aggregation ##########")
+    # Relative loss of total value compared to the optimisation with all the hours
+    for timehorizon, horizon_results in results.items():
+        full_time = horizon_results['full']['time']
+        for name, r in horizon_results.items():
+            print("horizon %2i days %-15s %8.3fs (x%4.1f) total value %12.1f loss %.4f%%"
+                  % (timehorizon, name, r['time'], full_time / r['time'], r['total_value'],
+                     r.get('relative_loss', 0) * 100))
+
+
+def create_optimiser(backend, ppt):
+    if (backend == "dp"):
+        from optimize_dynamic import DynamicProgrammingOptimisation
+        return DynamicProgrammingOptimisation(ppt)
+    elif (backend == "milp"):
+        from optimize_milp import MILPScheduleOptimization
+        return MILPScheduleOptimization(ppt)
+    raise ValueError("Unknown backend " + backend)
+
+
+def solve_window(backend, ppt, prices, step_durations, level):
+    """
+    Solve one price window in the current process.
+    Returns the time, the increase of the peak memory of the process in MB and the total cashflow.
+    """
+    optimiser = create_optimiser(backend, ppt)
+    # Warm up (numba compilation, imports), not measured
+    optimiser.calculate_optimal_schedule(prices[0:2], level, 0, level, step_durations[0:2])
+
+    peak_memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    result = optimiser.calculate_optimal_schedule(prices, level, 0, level, step_durations)
+    duration = time.perf_counter() - start
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_memory_before
+    return {'time': duration, 'memory': peak_memory / 1024, 'total_cashflow': result['total_cashflow']}
+
+
+def benchmark_dp_vs_milp(ppt, windows):
+    """
+    Run the dynamic programming and the MILP optimisation on the same price windows.
+    Each solve is done in a new process, so that the peak memory of one solve does not hide the other.
+
+    Parameters
+    ----------
+    ppt : IPumpStoragePlant
+        The power plant
+    windows : list of (prices, step durations)
+
+    Returns
+    -------
+    list with the results of both backends and the relative objective gap of the MILP for each window
+    """
+    results = []
+    level = ppt.get_max_level() / 2
+    for prices, step_durations in windows:
+        result = {'n_steps': len(prices)}
+        for backend in ("dp", "milp"):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                result[backend] = executor.submit(solve_window, backend, ppt, prices, step_durations, level).result()
+        result['objective_gap'] = ((result['milp']['total_cashflow'] - result['dp']['total_cashflow'])
+                                   / abs(result['milp']['total_cashflow']))
+        results.append(result)
+    return results
+
+
+def print_dp_vs_milp_benchmark(results):
+    print("########## Dynamic programming vs MILP ##########")
+    print("%8s %12s %12s %12s %12s %12s" % ("steps", "dp time", "milp time", "dp memory", "milp memory", "gap"))
+    for r in results:
+        print("%8i %11.4fs %11.4fs %10.1fMB %10.1fMB %11.4f%%" % (r['n_steps'], r['dp']['time'], r['milp']['time'],
+                                                                 r['dp']['memory'], r['milp']['memory'],
+                                                                 r['objective_gap'] * 100))
+
+
+def get_intraday_windows(n_days_list, first_day=0):
+    """
+    Price windows of the intraday optimisation from price.mat:
+        intraday 2 prices of the first day (quarter hours) and day ahead prices of the following days (hours).
+    """
+    from input import get_price_data
+    from util import downsample_mean
+
+    price_1, price_2, price_3 = get_price_data()
+    price_1 = downsample_mean(price_1, 4)
+
+    windows = []
+    for n_days in n_days_list:
+        prices = np.concatenate((price_3[first_day], price_1[first_day + 1:first_day + n_days].flatten()))
+        step_durations = np.concatenate((np.ones(96) * 0.25, np.ones((n_days - 1) * 24)))
+        windows.append((prices, step_durations))
+    return windows
+
+
+def get_best_time(function, repeat):
+    """Best time of repeat calls of function, after a first call not measured (numba compilation, caches)."""
+    function()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def get_suite_plants():
+    from powerplant import PumpStoragePlantTest, PSWGoldisthal, PSWLimmern, Hongrin
+    return [("PumpStoragePlantTest", PumpStoragePlantTest()), ("PSWGoldisthal", PSWGoldisthal()),
+            ("PSWLimmern", PSWLimmern()), ("Hongrin", Hongrin())]
+
+
+def get_window(horizon):
+    """Random prices and step durations of an intraday window: one day of quarter hours, then hours."""
+    prices = get_random_prices(96 + (horizon - 1) * 24)
+    step_durations = np.concatenate((np.ones(96) * 0.25, np.ones((horizon - 1) * 24)))
+    return prices, step_durations
+
+
+def benchmark_suite_kernel(plants, horizons, repeat=3):
+    """
+    Time of the decision matrix computation (build_matrix) and of the backtracking of the schedule
+        for each power plant and each horizon in days.
+
+    Returns
+    -------
+    dict with the times in seconds, keys are "kernel/<plant>/<horizon>d" and "backtrack/<plant>/<horizon>d"
+    """
+    from optimize_dynamic import DynamicProgrammingOptimisation
+
+    timings = {}
+    for name, ppt in plants:
+        optimiser = DynamicProgrammingOptimisation(ppt)
+        initial_level = optimiser.n_energy_levels // 2
+        for horizon in horizons:
+            prices, step_durations = get_window(horizon)
+            timings["kernel/%s/%id" % (name, horizon)] = get_best_time(
+                lambda: optimiser.build_matrix(prices, optimiser.n_energy_levels, 0, initial_level, step_durations),
+                repeat)
+
+            profits, decisions = optimiser.build_matrix(prices, optimiser.n_energy_levels, 0, initial_level,
+                                                        step_durations)
+            timings["backtrack/%s/%id" % (name, horizon)] = get_best_time(
+                lambda: optimiser.backtrack(decisions, initial_level, step_durations), repeat)
+    return timings
+
+
+def benchmark_suite_year(n_days=365, timehorizon=7, repeat=1):
+    """
+    Time of the rolling optimisation of one year (n_days days) of price.mat
+        with the power plant of power-plant-informations.xlsx.
+
+    Returns
+    -------
+    dict with the time in seconds, key "year/<n_days>d/<timehorizon>d"
+    """
+    from input import get_price_data, read_power_plant_informations
+    from market import Market, PumpStoragePlantIRMarketOptimiserNDays
+    from optimize_dynamic import DynamicProgrammingOptimisation
+    from util import downsample_mean
+
+    price_1, price_2, price_3 = get_price_data()
+    price_1 = downsample_mean(price_1, 4)
+
+    ppt = read_power_plant_informations()
+    market_optimiser = PumpStoragePlantIRMarketOptimiserNDays(ppt, Market(), DynamicProgrammingOptimisation(ppt))
+    market_optimiser.timehorizon = timehorizon
+    market_optimiser.set_prices(price_1[0:n_days], price_2[0:n_days], price_3[0:n_days])
+
+    def optimise():
+        market_optimiser.market = Market()
+        market_optimiser.optimise()
+
+    return {"year/%id/%id" % (n_days, timehorizon): get_best_time(optimise, repeat)}
+
+
+def benchmark_suite_data_loading(repeat=3):
+    """
+    Time to load the prices (price.mat) and the power plant (power-plant-informations.xlsx).
+
+    Returns
+    -------
+    dict with the times in seconds, keys "loading/prices" and "loading/power_plant"
+    """
+    from input import get_price_data, read_power_plant_informations
+
+    return {"loading/prices": get_best_time(get_price_data, repeat),
+            "loading/power_plant": get_best_time(read_power_plant_informations, repeat)}
+
+
+def run_benchmark_suite(horizons=range(1, 15), n_days=365, repeat=3):
+    """
+    Run the whole benchmark suite: decision matrix and backtracking for each power plant and horizon,
+        rolling optimisation of one year, and data loading.
+
+    Returns
+    -------
+    dict with the description of the environment ('metadata') and the times in seconds ('timings')
+    """
+    import numba
+
+    timings = {}
+    timings.update(benchmark_suite_kernel(get_suite_plants(), horizons, repeat))
+    timings.update(benchmark_suite_year(n_days))
+    timings.update(benchmark_suite_data_loading(repeat))
+    return {
+        'metadata': {
+            'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': numba.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+        },
+        'timings': timings
+    }
+
+
+def save_benchmark_results(results, path):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+def load_benchmark_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_benchmark_results(results, baseline, tolerance=0.2, min_difference=1e-4):
+    """
+    Compare the times of a benchmark run with the times of a baseline run.
+
+    Parameters
+    ----------
+    results : dict
+        Results of run_benchmark_suite
+    baseline : dict
+        Results of run_benchmark_suite saved previously
+    tolerance : float
+        Relative slow down allowed before a benchmark is a regression, 0.2 means 20% slower
+    min_difference : float
+        Slow down in seconds ignored, the times of the shortest benchmarks are dominated by noise
+
+    Returns
+    -------
+    list with the name, the time, the baseline time, the ratio and the regression flag
+        of each benchmark present in both runs
+    """
+    comparison = []
+    for name, duration in results['timings'].items():
+        if (name not in baseline['timings']):
+            continue
+        baseline_duration = baseline['timings'][name]
+        ratio = duration / baseline_duration
+        comparison.append({'name': name, 'time': duration, 'baseline': baseline_duration, 'ratio': ratio,
+                           'regression': ratio > 1 + tolerance and duration - baseline_duration > min_difference})
+    return comparison
+
+
+def print_benchmark_suite(results):
+    print("########## Benchmark suite ##########")
+    for name, duration in results['timings'].items():
+        print("%-40s %11.6fs" % (name, duration))
+
+
+def print_benchmark_comparison(comparison):
+    print("########## Comparison with baseline ##########")
+    print("%-40s %12s %12s %8s" % ("", "time", "baseline", "ratio"))
+    for c in comparison:
+        print("%-40s %11.6fs %11.6fs %7.2fx %s" % (c['name'], c['time'], c['baseline'], c['ratio'],
+                                                  "REGRESSION" if c['regression'] else ""))
+
+
+def run_benchmark_suite_command(output=None, baseline=None, tolerance=0.2, quick=False):
+    """
+    Run the benchmark suite, save the results to output and compare them with the baseline file.
+    quick runs a subset (horizons 1, 7 and 14, 30 days of rolling optimisation, one repetition).
+
+    Returns
+    -------
+    1 if a benchmark is slower than the baseline by more than the tolerance, else 0
+    """
+    if (quick):
+        results = run_benchmark_suite(horizons=[1, 7, 14], n_days=30, repeat=1)
+    else:
+        results = run_benchmark_suite()
+    print_benchmark_suite(results)
+    if (output is not None):
+        save_benchmark_results(results, output)
+    if (baseline is None):
+        return 0
+
+    comparison = compare_benchmark_results(results, load_benchmark_results(baseline), tolerance)
+    print_benchmark_comparison(comparison)
+    return 1 if any(c['regression'] for c in comparison) else 0
+
+
+def run_all_benchmarks():
+    from powerplant import Hongrin, PSWLimmern, PumpStoragePlant
+
+    print_startup_benchmark(benchmark_startup())
+    for name, ppt in [("PSWLimmern", PSWLimmern()), ("Hongrin", Hongrin()),
+                      ("500 GWh reservoir", PumpStoragePlant(1000, 1000, 500000, 0.85))]:
+        print_multigrid_benchmark(name, benchmark_multigrid(ppt, [2, 4, 8, 16]))
+        print_kernel_threads_benchmark(name, benchmark_kernel_threads(ppt))
+        print_reachability_pruning_benchmark(name, benchmark_reachability_pruning(ppt))
+        print_checkpointed_backtracking_benchmark(name, benchmark_checkpointed_backtracking(ppt))
+    print_dp_vs_milp_benchmark(benchmark_dp_vs_milp(PumpStoragePlant(100, 100, 600, 0.75),
+                                                    get_intraday_windows([1, 2, 7])))
+    print_tail_aggregation_benchmark(benchmark_tail_aggregation([[1, 1, 1, 2, 4], [1, 1, 2, 4, 8], [1, 2, 4, 8]],
+                                                                [7, 14, 30], create_power_plant=PSWLimmern))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the optimisation. Without --suite, run the startup, "
+                                                 "multigrid, kernel, pruning, backtracking and MILP benchmarks.")
+    parser.add_argument("--suite", action="store_true", help="run the benchmark suite")
+    parser.add_argument("--check", action="store_true",
+                        help="check that the optimiser modes give the same results as the reference")
+    parser.add_argument("--quick", action="store_true", help="run a smaller benchmark suite")
+    parser.add_argument("--output", help="save the results of the benchmark suite to this json file")
+    parser.add_argument("--baseline", help="compare the benchmark suite with this json file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slow down allowed before a regression (default 0.2)")
+    args = parser.parse_args()
+
+    if (args.check):
+        sys.exit(run_check_command())
+    if (args.suite):
+        sys.exit(run_benchmark_suite_command(args.output, args.baseline, args.tolerance, args.quick))
+    run_all_benchmarks()
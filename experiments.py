@@ -1,12 +1,19 @@
 from input import read_power_plant_informations
 from market import Market, PumpStoragePlantIRMarketOptimiserNDays
 from optimize_dynamic import DynamicProgrammingOptimisation
-from output import plot_powerplant, plot_market, plot_real_and_intrinsic_value, plot_real_and_intrinsic_value_cumsum, print_stats, plot_total_value_vs_intrinsic_value
+from optimize_cache import CachedScheduleOptimization
 from powerplant import IPumpStoragePlant
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import multiprocessing
+import mmap
 import time
 import numpy as np
 
 def default_case(price_1, price_2, price_3):
+    # matplotlib is only imported when plotting, headless runs start faster without it
+    from output import plot_powerplant, plot_market, plot_real_and_intrinsic_value_cumsum, print_stats
+
     ppt_fast: IPumpStoragePlant = read_power_plant_informations()
     market_fast: Market = Market()
     market_optimiser_fast = PumpStoragePlantIRMarketOptimiserNDays(ppt_fast, market_fast, DynamicProgrammingOptimisation(ppt_fast))
@@ -128,4 +135,158 @@ def cashflow_by_end_level_timehorizont(end_levels, timehorizonts, price_1, price
 
         print("Total value:     %s" % str(total_value[str(h)]))
         print("Intrinsic value: %s" % str(instrinsic_value[str(h)]))
-    return total_value, instrinsic_value
\ No newline at end of file
+    return total_value, instrinsic_value
+
+def run_optimisation(price_1, price_2, price_3, timehorizon=7, end_level=None, capacity=None, cache_directory=None):
+    """
+    Run one full optimisation with the given parameters.
+    Parameters left to None keep the default value.
+    With a cache directory, the schedules are saved on disk and the optimisations already done by previous runs
+        (in any process) are skipped, see CachedScheduleOptimization.
+
+    Returns
+    -------
+    total value and intrinsic value
+    """
+    ppt: IPumpStoragePlant = read_power_plant_informations()
+    if (capacity is not None):
+        ppt.max_level = capacity
+    market: Market = Market()
+    optimiser = DynamicProgrammingOptimisation(ppt)
+    if (cache_directory is not None):
+        optimiser = CachedScheduleOptimization(optimiser, cache_directory=cache_directory)
+    market_optimiser = PumpStoragePlantIRMarketOptimiserNDays(ppt, market, optimiser)
+    if (end_level is not None):
+        market_optimiser.end_level = end_level
+    market_optimiser.timehorizon = timehorizon
+
+    market_optimiser.set_prices(price_1, price_2, price_3)
+    market_optimiser.optimise()
+
+    total_value = market.rolling_da_id_1 + market.rolling_id_1_id_2 + market.rollging_id_2_da
+    instrinsic_value = np.sum(ppt.state.cashflow_schedule)
+    return total_value, instrinsic_value
+
+
+# Prices of the worker process, in shared memory or memory mapped from the price store
+_worker_prices = None
+_worker_shared_memories = None
+
+
+def _attach_prices(kind, name, offset, shape, dtype):
+    if (kind == "memmap"):
+        return np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape), None
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def _init_worker(shared_prices):
+    """
+    Attach the worker process to the shared prices and compile the numba functions once.
+    """
+    global _worker_prices, _worker_shared_memories
+    attached = [_attach_prices(*description) for description in shared_prices]
+    _worker_prices = [prices for prices, shm in attached]
+    _worker_shared_memories = [shm for prices, shm in attached if shm is not None]
+
+    # Short optimisation, so that numba compiles the functions before the first task
+    run_optimisation(*[prices[0:2] for prices in _worker_prices], timehorizon=2)
+
+
+def _run_worker_optimisation(parameters):
+    return run_optimisation(*_worker_prices, **parameters)
+
+
+def parallel_sweep(parameters, price_1, price_2, price_3, max_workers=None):
+    """
+    Run one optimisation for each parameter set on a pool of processes.
+    The prices are given to the processes with shared memory, they are not copied for each task.
+    Prices opened with input.get_price_data_memmap are not copied at all, the processes map the same file.
+
+    Parameters
+    ----------
+    parameters : list of dict
+        Keyword arguments of run_optimisation for each optimisation.
+    max_workers : int
+        Number of processes, all cpus if None.
+
+    Returns
+    -------
+    list of (total value, intrinsic value), in the same order than parameters
+    """
+    shared_memories = []
+    shared_prices = []
+    try:
+        for prices in (price_1, price_2, price_3):
+            # Only a full array of a file has a valid offset, slices are copied to shared memory
+            if (isinstance(prices, np.memmap) and isinstance(prices.base, mmap.mmap)
+                    and prices.flags['C_CONTIGUOUS']):
+                shared_prices.append(("memmap", prices.filename, prices.offset, prices.shape, prices.dtype))
+                continue
+            prices = np.ascontiguousarray(prices, dtype=np.float64)
+            shm = shared_memory.SharedMemory(create=True, size=max(prices.nbytes, 1))
+            shared_memories.append(shm)
+            np.ndarray(prices.shape, dtype=prices.dtype, buffer=shm.buf)[...] = prices
+            shared_prices.append(("shared_memory", shm.name, 0, prices.shape, prices.dtype))
+
+        # Forked processes inherit the numba threads started by the parallel functions when optimize_dynamic is
+        # imported, and the main process then hangs when it exits. Spawned processes start without them.
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(shared_prices,),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            return list(executor.map(_run_worker_optimisation, parameters))
+    finally:
+        for shm in shared_memories:
+            shm.close()
+            shm.unlink()
+
+
+def cashflow_by_timehorizont_parallel(min_timehorizont, max_timehorizont, price_1, price_2, price_3, max_workers=None):
+    """
+    Same as cashflow_by_timehorizont, but the optimisations run in parallel.
+    """
+    timehorizonts = list(range(min_timehorizont, max_timehorizont + 1))
+    results = parallel_sweep([{'timehorizon': h} for h in timehorizonts], price_1, price_2, price_3, max_workers)
+
+    total_value = {str(h): result[0] for h, result in zip(timehorizonts, results)}
+    instrinsic_value = {str(h): result[1] for h, result in zip(timehorizonts, results)}
+    return total_value, instrinsic_value
+
+
+def cashflow_by_end_level_parallel(end_levels, price_1, price_2, price_3, timehorizon=7, max_workers=None):
+    """
+    Same as cashflow_by_end_level, but the optimisations run in parallel.
+    """
+    results = parallel_sweep([{'end_level': lvl, 'timehorizon': timehorizon} for lvl in end_levels],
+                             price_1, price_2, price_3, max_workers)
+
+    total_value = {str(lvl): result[0] for lvl, result in zip(end_levels, results)}
+    instrinsic_value = {str(lvl): result[1] for lvl, result in zip(end_levels, results)}
+    return total_value, instrinsic_value
+
+
+def cashflow_by_capacity_parallel(timehorizont, capacities, price_1, price_2, price_3, max_workers=None):
+    """
+    Same as cashflow_by_capacity, but the optimisations run in parallel.
+    """
+    results = parallel_sweep([{'capacity': capacity, 'timehorizon': timehorizont} for capacity in capacities],
+                             price_1, price_2, price_3, max_workers)
+
+    total_value = {str(capacity): result[0] for capacity, result in zip(capacities, results)}
+    instrinsic_value = {str(capacity): result[1] for capacity, result in zip(capacities, results)}
+    return total_value, instrinsic_value
+
+
+def cashflow_by_end_level_timehorizont_parallel(end_levels, timehorizonts, price_1, price_2, price_3, max_workers=None):
+    """
+    Same as cashflow_by_end_level_timehorizont, but all the optimisations of the grid run in parallel.
+    """
+    grid = [(h, lvl) for h in timehorizonts for lvl in end_levels]
+    results = parallel_sweep([{'end_level': lvl, 'timehorizon': h} for h, lvl in grid],
+                             price_1, price_2, price_3, max_workers)
+
+    total_value = {str(h): {} for h in timehorizonts}
+    instrinsic_value = {str(h): {} for h in timehorizonts}
+    for (h, lvl), result in zip(grid, results):
+        total_value[str(h)][str(lvl)] = result[0]
+        instrinsic_value[str(h)][str(lvl)] = result[1]
+    return total_value, instrinsic_value
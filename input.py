@@ -1,12 +1,23 @@
-import pandas as pd
-import scipy as sp
+import json
+import os
+import tempfile
+
+import numpy as np
 
 from powerplant import PumpStoragePlant
 
+# scipy and pandas are imported in the functions, they are slow to import and not always needed
+
+# Directory of the binary price store created from price.mat by convert_price_data
+PRICE_STORE_DIRECTORY = "price-store"
+PRICE_STORE_METADATA = "metadata.json"
+
+
+def get_price_data(path='price.mat'):
+    from scipy.io import loadmat
 
-def get_price_data():
     # Import
-    price_data = sp.io.loadmat('price.mat')
+    price_data = loadmat(path)
 
     # Get data
     price_data = price_data['Price'][0][0]
@@ -16,22 +27,189 @@ def get_price_data():
     return (market_lvl_1, market_lvl_2, market_lvl_3)
 
 
-def read_power_plant_informations():
-    storage_data = pd.ExcelFile("power-plant-informations.xlsx")
+def to_python_number(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def parse_power_plant_parameters(path='power-plant-informations.xlsx', sheet_names=("ps1",)):
+    """
+    Read the parameters of the power plants of the given sheets from the excel file, only these sheets are parsed.
+
+    Returns
+    -------
+    dict with the parameters of each sheet: max_turb_power, max_pump_power, max_level and pump_efficiency
+    """
+    import pandas as pd
+
+    storage_data = pd.ExcelFile(path)
+
+    plants = {}
+    for sheet_name in sheet_names:
+        values = storage_data.parse(sheet_name).values
+        # Storage
+        storage_level_max = values[7, 2]
+
+        # Turbine and Pump
+        storage_turb_max_el = values[1, 2]
+        storage_pump_max_el = values[3, 2]
+        # The pump efficiency of the sheet (values[6, 2]) is not used
+
+        pump_efficiency = 0.75
+
+        # Python numbers, so that the parameters can be saved as json
+        plants[sheet_name] = {
+            'max_turb_power': to_python_number(storage_turb_max_el),
+            'max_pump_power': to_python_number(storage_pump_max_el),
+            'max_level': to_python_number(storage_level_max),
+            'pump_efficiency': pump_efficiency
+        }
+    return plants
+
+
+# Parameters already read in this process, key is (path, size, mtime) of the excel file
+_power_plant_parameters_cache = {}
+
+
+def get_power_plant_cache_path(path):
+    return os.path.splitext(path)[0] + ".cache.json"
+
+
+def read_power_plant_parameters(path='power-plant-informations.xlsx', sheet_names=("ps1",)):
+    """
+    Parameters of the power plants of the given sheets, see parse_power_plant_parameters.
+    The excel file is only parsed if it changed: the parameters are cached in the process and in a json file
+        next to the excel file, both are invalid as soon as the size or the modification time of the file changes.
+    """
+    source = os.stat(path)
+    key = (os.path.abspath(path), source.st_size, source.st_mtime_ns)
+    plants = _power_plant_parameters_cache.setdefault(key, {})
+    missing = [sheet_name for sheet_name in sheet_names if sheet_name not in plants]
+    if (len(missing) == 0):
+        return {sheet_name: plants[sheet_name] for sheet_name in sheet_names}
+
+    cache_path = get_power_plant_cache_path(path)
+    cache = {'source_size': source.st_size, 'source_mtime': source.st_mtime_ns, 'plants': {}}
+    if (os.path.exists(cache_path)):
+        try:
+            with open(cache_path) as file:
+                saved_cache = json.load(file)
+            if (saved_cache['source_size'] == source.st_size and saved_cache['source_mtime'] == source.st_mtime_ns):
+                cache = saved_cache
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # Unreadable cache file, the parameters are parsed again and the file is replaced
+    plants.update(cache['plants'])
+
+    missing = [sheet_name for sheet_name in sheet_names if sheet_name not in plants]
+    if (len(missing) > 0):
+        plants.update(parse_power_plant_parameters(path, missing))
+        cache['plants'] = dict(plants)
+        try:
+            # Written to a temporary file of this process first, the processes of parallel_sweep parse the excel
+            # file at the same time and never read half written files
+            file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_path) or ".")
+            try:
+                with os.fdopen(file_descriptor, "w") as file:
+                    json.dump(cache, file, indent=2)
+                os.replace(temporary_path, cache_path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+        except OSError:
+            pass  # Read only directory, the parameters are only cached in the process
+    return {sheet_name: plants[sheet_name] for sheet_name in sheet_names}
+
+
+def read_power_plants(path='power-plant-informations.xlsx', sheet_names=("ps1",)):
+    """
+    New power plants for the given sheets of the excel file, with cached parameters.
+
+    Returns
+    -------
+    dict with a PumpStoragePlant for each sheet name
+    """
+    return {sheet_name: PumpStoragePlant(parameters['max_turb_power'], parameters['max_pump_power'],
+                                         parameters['max_level'], parameters['pump_efficiency'])
+            for sheet_name, parameters in read_power_plant_parameters(path, sheet_names).items()}
+
+
+def read_power_plant_informations(path='power-plant-informations.xlsx', sheet_name="ps1"):
+    """
+    New power plant with the parameters of the sheet of the excel file.
+    The excel file is only parsed the first time, see read_power_plant_parameters.
+    """
+    return read_power_plants(path, (sheet_name,))[sheet_name]
+
+
+def convert_price_data(path='price.mat', store_directory=PRICE_STORE_DIRECTORY):
+    """
+    Convert the prices of price.mat to a store of .npy files that can be memory mapped.
+    Stores the three market levels as they are (one row per day), and the day ahead prices
+        averaged per hour like in main.py, with the resolution of each array in metadata.json.
+
+    Returns
+    -------
+    dict with the metadata of the store
+    """
+    from util import downsample_mean
+
+    market_lvl_1, market_lvl_2, market_lvl_3 = get_price_data(path)
+    n_steps_day = market_lvl_1.shape[1]
+    arrays = {
+        'day_ahead': (downsample_mean(market_lvl_1, int(n_steps_day / 24)), 1),
+        'day_ahead_raw': (market_lvl_1, 24 / n_steps_day),
+        'intraday_1': (market_lvl_2, 24 / market_lvl_2.shape[1]),
+        'intraday_2': (market_lvl_3, 24 / market_lvl_3.shape[1]),
+    }
+
+    os.makedirs(store_directory, exist_ok=True)
+    source = os.stat(path)
+    metadata = {'source': os.path.abspath(path), 'source_size': source.st_size, 'source_mtime': source.st_mtime_ns,
+                'arrays': {}}
+    for name, (prices, step_duration) in arrays.items():
+        # C order, so that each day is contiguous in the file
+        prices = np.ascontiguousarray(prices, dtype=np.float64)
+        np.save(os.path.join(store_directory, name + ".npy"), prices)
+        metadata['arrays'][name] = {'file': name + ".npy", 'shape': list(prices.shape), 'dtype': str(prices.dtype),
+                                    'step_duration': step_duration}
+
+    # The metadata is written last, a store without metadata is incomplete
+    with open(os.path.join(store_directory, PRICE_STORE_METADATA), "w") as file:
+        json.dump(metadata, file, indent=2)
+    return metadata
+
+
+def is_price_store_up_to_date(path='price.mat', store_directory=PRICE_STORE_DIRECTORY):
+    """True if the store exists and was converted from the current version of the file path."""
+    metadata_path = os.path.join(store_directory, PRICE_STORE_METADATA)
+    if (not os.path.exists(metadata_path)):
+        return False
+    with open(metadata_path) as file:
+        metadata = json.load(file)
+    source = os.stat(path)
+    return metadata['source_size'] == source.st_size and metadata['source_mtime'] == source.st_mtime_ns
+
+
+def load_price_store(store_directory=PRICE_STORE_DIRECTORY, names=('day_ahead', 'intraday_1', 'intraday_2')):
+    """
+    Open the arrays of the price store without reading them, the pages are read from the disk when used
+        and shared by all the processes that open the same store.
 
-    dfs = {sheet_name: storage_data.parse(sheet_name)
-           for sheet_name in storage_data.sheet_names}
-    # Storage
-    storage_level_max = dfs["ps1"].values[7, 2]
-    storage_level_anfang = 0.5 * storage_level_max
+    Returns
+    -------
+    tuple with a read only np.memmap for each name, one row per day
+    """
+    return tuple(np.load(os.path.join(store_directory, name + ".npy"), mmap_mode='r') for name in names)
 
-    # Turbine and Pump
-    storage_turb_max_el = dfs["ps1"].values[1, 2]
-    storage_turb_min_el = dfs["ps1"].values[2, 2]
-    storage_pump_max_el = dfs["ps1"].values[3, 2]
-    storage_pump_min_el = dfs["ps1"].values[4, 2]
-    storage_pump_eta = dfs["ps1"].values[6, 2]
 
-    pump_efficiency = 0.75
+def get_price_data_memmap(path='price.mat', store_directory=PRICE_STORE_DIRECTORY):
+    """
+    Same prices as get_price_data, with the day ahead prices averaged per hour like in main.py.
+    The prices are read from the binary store, converted from path first if it is missing or outdated.
 
-    return PumpStoragePlant(storage_turb_max_el, storage_pump_max_el, storage_level_max, pump_efficiency)
+    Returns
+    -------
+    day ahead (hourly), intraday 1 and intraday 2 prices as read only np.memmap
+    """
+    if (not is_price_store_up_to_date(path, store_directory)):
+        convert_price_data(path, store_directory)
+    return load_price_store(store_directory)
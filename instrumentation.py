@@ -0,0 +1,145 @@
+import csv
+import json
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, the peak memory is not recorded
+    resource = None
+
+
+class NullInstrumentation:
+    """
+    Instrumentation that records nothing, used when the instrumentation is disabled.
+    All the methods do nothing, so that the instrumented code costs only a few function calls.
+    """
+
+    def start_day(self, day: int):
+        pass
+
+    def end_day(self):
+        pass
+
+    def stage(self, name: str):
+        return NULL_STAGE
+
+    def count(self, name: str, value=1):
+        pass
+
+    def set(self, name: str, value):
+        pass
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+class Stage:
+    """Measures the time of a with block and adds it to the current day record of the instrumentation."""
+
+    def __init__(self, record: dict, name: str, lock=None):
+        self.record = record
+        self.name = name
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        with self.lock:
+            self.record[self.name] = self.record.get(self.name, 0) + duration
+        return False
+
+
+class Instrumentation(NullInstrumentation):
+    """
+    Records the time of each stage and counters for each optimised day.
+
+    One record (dict) per day, with:
+        'day' : index of the day
+        'time' : total time of the day in seconds
+        'time_<stage>' : time of the stage in seconds, summed over the calls of the day
+        counters and values given with count and set
+        'peak_memory_mb' : peak memory of the process at the end of the day (not on Windows)
+
+    Stages of the rolling optimisation (PumpStoragePlantIRMarketOptimiserNDays):
+        window : building the price timeseries
+        tail, solve_da, solve_id_1, solve_id_2 : optimisation of the shared tail and of each market level
+        solve_concurrent : optimisation of the three market levels at the same time, replaces solve_da, solve_id_1
+            and solve_id_2 with concurrent_solves, the stages of the dynamic programming then overlap
+        rolling : rolling decisions and market transactions
+        state_update : execution of the schedule by the power plant
+    Stages of the dynamic programming, included in the stages above:
+        dp : decision matrix
+        backtrack : schedule from the decision matrix
+    """
+
+    def __init__(self, callback=None):
+        """
+        Parameters
+        ----------
+        callback : function
+            Called with the record of each day when the day is done.
+        """
+        self.callback = callback
+        self.records = []
+        self.record = {}
+        # The stages and counters of the dynamic programming are recorded from threads with concurrent_solves
+        self.lock = threading.Lock()
+
+    def start_day(self, day: int):
+        self.record = {'day': day}
+        self.day_start = time.perf_counter()
+
+    def end_day(self):
+        self.record['time'] = time.perf_counter() - self.day_start
+        if (resource is not None):
+            # ru_maxrss is in kB on Linux
+            self.record['peak_memory_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.records.append(self.record)
+        if (self.callback is not None):
+            self.callback(self.record)
+
+    def stage(self, name: str):
+        return Stage(self.record, "time_" + name, self.lock)
+
+    def count(self, name: str, value=1):
+        with self.lock:
+            self.record[name] = self.record.get(name, 0) + value
+
+    def set(self, name: str, value):
+        with self.lock:
+            self.record[name] = value
+
+    def get_totals(self):
+        """Sum of the times and counters over all the days."""
+        totals = {}
+        for record in self.records:
+            for name, value in record.items():
+                if (name not in ('day', 'peak_memory_mb', 'n_energy_levels')):
+                    totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def to_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.records, file, indent=2)
+
+    def to_csv(self, path):
+        columns = []
+        for record in self.records:
+            columns += [name for name in record if name not in columns]
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.records)
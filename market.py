@@ -1,21 +1,207 @@
+import collections
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from instrumentation import NULL_INSTRUMENTATION
 from optimize import IScheduleOptimization
+from optimize_cache import CachedScheduleOptimization
 from powerplant import IPumpStoragePlant
+from util import downsample_mean, downsample_sum, upsample_split
+
+
+class TransactionLedger:
+    """
+    Cashflows of the transactions of one market level.
+    Stored in a preallocated array with one row per day and one column per time step.
+    """
+
+    def __init__(self, n_days=0, max_days=None):
+        """
+        Parameters
+        ----------
+        n_days : int
+            Number of days to preallocate.
+        max_days : int
+            If given, only the cashflows of the last max_days days are kept, in a ring buffer.
+            The days must then be added in chronological order. The total covers all the days.
+        """
+        self.max_days = max_days
+        self.cashflows = None
+        self.n_days = 0  # Number of days up to the last day with transactions
+        self.total = 0   # Sum of all cashflows
+        self.n_days_allocated = n_days
+
+    def allocate(self, n_days, n_step_day=None):
+        """
+        Preallocate the ledger for n_days days.
+        The number of time steps of a day is taken from the first transactions if not given.
+        """
+        if (self.max_days is not None):
+            self.n_days_allocated = self.max_days
+        else:
+            self.n_days_allocated = max(n_days, self.n_days)
+        if (n_step_day is None):
+            if (self.cashflows is None):
+                return
+            n_step_day = self.cashflows.shape[1]
+
+        cashflows = np.zeros((self.n_days_allocated, n_step_day))
+        if (self.cashflows is not None):
+            n_kept_days = min(self.n_days, self.n_days_allocated)
+            cashflows[0:n_kept_days] = self.cashflows[0:n_kept_days]
+        self.cashflows = cashflows
+
+    def add(self, day, cashflow):
+        if (self.cashflows is None):
+            self.allocate(max(self.n_days_allocated, day + 1), len(cashflow))
+        elif (self.max_days is None and day >= len(self.cashflows)):
+            # More days than allocated, at least double the size
+            self.allocate(max(2 * len(self.cashflows), day + 1))
+
+        if (self.max_days is not None):
+            # Days skipped since the last transactions have no cashflow
+            for skipped_day in range(max(self.n_days, day + 1 - self.max_days), day):
+                self.cashflows[skipped_day % self.max_days] = 0
+        self.cashflows[day % len(self.cashflows)] = cashflow
+        self.n_days = max(self.n_days, day + 1)
+        self.total += np.sum(cashflow)
+
+    def get_checkpoint(self):
+        """
+        Cashflows and total of the ledger, see set_checkpoint.
+        """
+        cashflows = self.cashflows if self.cashflows is not None else np.zeros((0, 0))
+        return {
+            'cashflows': cashflows[0:min(self.n_days, len(cashflows))],
+            'n_days': self.n_days,
+            'total': self.total
+        }
+
+    def set_checkpoint(self, checkpoint):
+        """
+        Restore the ledger saved with get_checkpoint.
+        """
+        self.n_days = int(checkpoint['n_days'])
+        self.total = checkpoint['total'][()]
+        self.cashflows = None
+        if (len(checkpoint['cashflows']) > 0):
+            self.cashflows = np.array(checkpoint['cashflows'], dtype=np.float64)
+
+    def get_day(self, day):
+        """
+        Cashflow of each time step of the day, without copy. The day must still be in the ledger.
+        """
+        return self.cashflows[day % len(self.cashflows)]
+
+    @property
+    def history(self):
+        """
+        Cashflow for each day and time step, without copy.
+        With max_days, only the last max_days days, copied when the ring buffer is full.
+        """
+        if (self.cashflows is None):
+            return np.zeros((0, 0))
+        if (self.n_days <= len(self.cashflows)):
+            return self.cashflows[0:self.n_days]
+        first_row = self.n_days % len(self.cashflows)
+        return np.concatenate((self.cashflows[first_row:], self.cashflows[0:first_row]))
+
+    def get_daily_cashflow(self, n_days=None):
+        """
+        Sum of the cashflows of each day.
+        Days after the last transactions are 0 when n_days is given.
+        """
+        daily_cashflow = np.sum(self.history, axis=1)
+        if (n_days is not None):
+            daily_cashflow = np.concatenate((daily_cashflow[0:n_days], np.zeros(max(0, n_days - len(daily_cashflow)))))
+        return daily_cashflow
+
+    def get_cumulative_cashflow(self):
+        """
+        Cumulated sum of the daily cashflows.
+        """
+        return np.cumsum(self.get_daily_cashflow())
 
 
 class Market:
 
-    def __init__(self):
-        self.rolling_da_id_1 = 0
-        self.rolling_id_1_id_2 = 0
-        self.rollging_id_2_da = 0
+    def __init__(self, max_days=None):
+        """
+        Parameters
+        ----------
+        max_days : int
+            If given, only the transactions of the last max_days days are kept, see TransactionLedger.
+        """
+        self.clear(max_days)
 
-        self.transaction_history_da = {}
-        self.transaction_history_id_1 = {}
-        self.transaction_history_id_2 = {}
+    def clear(self, max_days=None):
+        """
+        Remove all the transactions.
+        """
+        self.ledger_da = TransactionLedger(max_days=max_days)
+        self.ledger_id_1 = TransactionLedger(max_days=max_days)
+        self.ledger_id_2 = TransactionLedger(max_days=max_days)
 
-        pass
+    def allocate(self, n_days):
+        """
+        Preallocate the ledgers of all market levels for n_days days.
+        """
+        for ledger in (self.ledger_da, self.ledger_id_1, self.ledger_id_2):
+            ledger.allocate(n_days)
+
+    def get_checkpoint(self):
+        """
+        Transactions of all market levels, see set_checkpoint.
+        """
+        checkpoint = {}
+        for name, ledger in (('da', self.ledger_da), ('id_1', self.ledger_id_1), ('id_2', self.ledger_id_2)):
+            for key, value in ledger.get_checkpoint().items():
+                checkpoint[name + "_" + key] = value
+        return checkpoint
+
+    def set_checkpoint(self, checkpoint):
+        """
+        Restore the transactions saved with get_checkpoint.
+        """
+        for name, ledger in (('da', self.ledger_da), ('id_1', self.ledger_id_1), ('id_2', self.ledger_id_2)):
+            ledger.set_checkpoint({key: checkpoint[name + "_" + key] for key in ('cashflows', 'n_days', 'total')})
+
+    @property
+    def rolling_da_id_1(self):
+        return self.ledger_id_1.total
+
+    @property
+    def rolling_id_1_id_2(self):
+        return self.ledger_id_2.total
+
+    @property
+    def rollging_id_2_da(self):
+        return self.ledger_da.total
+
+    @property
+    def transaction_history_da(self):
+        return self.ledger_da.history
+
+    @property
+    def transaction_history_id_1(self):
+        return self.ledger_id_1.history
+
+    @property
+    def transaction_history_id_2(self):
+        return self.ledger_id_2.history
+
+    def get_daily_cashflow(self, n_days=None):
+        """
+        Sum of the cashflows of all market levels for each day.
+        """
+        if (n_days is None):
+            n_days = max(self.ledger_da.n_days, self.ledger_id_1.n_days, self.ledger_id_2.n_days)
+        return (self.ledger_da.get_daily_cashflow(n_days)
+                + self.ledger_id_1.get_daily_cashflow(n_days)
+                + self.ledger_id_2.get_daily_cashflow(n_days))
 
     def calculate_cashflow(self, prices, sell):
         """
@@ -46,8 +232,7 @@ class Market:
             The day index.
         """
         cashflow = self.calculate_cashflow(prices, sell)
-        self.rollging_id_2_da += np.sum(cashflow)
-        self.transaction_history_da[str(day)] = cashflow
+        self.ledger_da.add(day, cashflow)
         return cashflow
     
     def do_transactions_id(self, prices, sell, day, id_type):
@@ -66,11 +251,9 @@ class Market:
         """
         cashflow = self.calculate_cashflow(prices, sell)
         if id_type == 1:
-            self.rolling_da_id_1 += np.sum(cashflow)
-            self.transaction_history_id_1[str(day)] = cashflow
+            self.ledger_id_1.add(day, cashflow)
         elif id_type == 2:
-            self.rolling_id_1_id_2 += np.sum(cashflow)
-            self.transaction_history_id_2[str(day)] = cashflow
+            self.ledger_id_2.add(day, cashflow)
         return cashflow
 
 
@@ -116,85 +299,351 @@ class PumpStoragePlantIRMarketOptimiserNDays:
         # end level of optimisation periodes (after self.timehorizon days)
         self.end_level = ppt.state.energy_level
 
+        # Duration in hours of the time steps of the days after the optimised day, from the second day of the
+        # timeserie on, the last value is used for all the following days. For example [1, 4, 8]: hours the
+        # second day, blocks of 4 hours the third day and blocks of 8 hours after. None keeps all the hours.
+        # The distant days only shape the value of the energy level at the end of the first day, longer time steps
+        # make long time horizons faster for a small loss of profit.
+        self.tail_aggregation = None
+
+        # If True, the day ahead, intraday 1 and intraday 2 schedules of a day are optimised at the same time in
+        # threads, they all start from the state of the plant at the beginning of the day. The rolling decisions
+        # and the transactions are done afterwards in the usual order, the results are the same.
+        # The compiled functions of DynamicProgrammingOptimisation release the GIL, it is meant to be used from
+        # threads with the "scatter" kernel. The schedules are optimised one after the other with the "gather"
+        # kernel or when the threading layer of numba is not tbb or omp: the parallel compiled functions are not
+        # safe to call from several threads with the workqueue layer. CachedScheduleOptimization is not thread
+        # safe, a ValueError is raised.
+        self.concurrent_solves = False
+
+        self.instrumentation = NULL_INSTRUMENTATION
+
+    def set_instrumentation(self, instrumentation=None):
+        """
+        Record the timings and counters of each day of the optimisation with the given Instrumentation
+            (see instrumentation.py), also in the schedule optimiser. None disables the instrumentation.
+        """
+        if (instrumentation is None):
+            instrumentation = NULL_INSTRUMENTATION
+        self.instrumentation = instrumentation
+        self.optimiser.instrumentation = instrumentation
+
     def set_prices(self, day_ahead, intraday_1, intraday_2):
-        self.day_ahead_prices = day_ahead.flatten()
-        self.intraday_1_prices = intraday_1.flatten()
-        self.intraday_2_prices = intraday_2.flatten()
+        # ravel does not copy contiguous arrays, prices can stay in shared memory
+        self.day_ahead_prices = np.ravel(day_ahead)
+        self.intraday_1_prices = np.ravel(intraday_1)
+        self.intraday_2_prices = np.ravel(intraday_2)
 
-    def optimise(self):
+    def optimise(self, checkpoint_path=None, checkpoint_interval=30, resume=False):
         """
         Optimise the pump storage plant based on the prices given previously with the set_prices function
         Fills the market object and the power plant state object with data like
             transactions, power exchange and fill level
         Side effect: the power plant state is cleared and changes
+
+        Parameters
+        ----------
+        checkpoint_path : str
+            If given, the power plant state and the market are saved to this file every checkpoint_interval days
+                and after the last day.
+        checkpoint_interval : int
+            Number of days between two checkpoints.
+        resume : bool
+            If True and the checkpoint file exists, continue after the last day of the checkpoint instead of
+                starting at the first day. The results are the same as without interruption.
         """
 
         self.ppt.state.clear()
+        first_day = 0
+        if (resume and checkpoint_path is not None and os.path.exists(checkpoint_path)):
+            first_day = self.load_checkpoint(checkpoint_path)
 
         number_of_days = int(len(self.day_ahead_prices) / self.n_step_da_day)
+        self.ppt.state.allocate(number_of_days, self.n_step_id_day)
+        self.market.allocate(number_of_days)
 
-        last_optimal_schedule = []
-
-        for i in range(0, number_of_days):
+        for i in range(first_day, number_of_days):
             #print("Calculate day %i / %i" % (i, number_of_days))
-            # Optimal first transactions of day
-            da_prices, step_durations = self.get_da_only_prices(i, self.timehorizon)
-            last_optimal_schedule = self.calculate_schedule_da(da_prices, step_durations, i)
+            self.optimise_day(i)
+            if (checkpoint_path is not None and ((i + 1) % checkpoint_interval == 0 or i + 1 == number_of_days)):
+                self.save_checkpoint(checkpoint_path, i + 1)
+
+        print("Done %i days calculated" % (number_of_days))
+
+    def resume(self, checkpoint_path, checkpoint_interval=30):
+        """
+        Continue an optimisation interrupted after a checkpoint, see optimise.
+        The prices and the parameters must be the same as in the interrupted optimisation.
+        """
+        self.optimise(checkpoint_path, checkpoint_interval, resume=True)
+
+    def get_checkpoint_fingerprint(self):
+        """
+        Hash of the prices, of the power plant and of the parameters of the optimisation and of the optimiser,
+        a checkpoint is only valid for the same values.
+        """
+        fingerprint = hashlib.sha1()
+        for prices in (self.day_ahead_prices, self.intraday_1_prices, self.intraday_2_prices):
+            fingerprint.update(np.ascontiguousarray(prices, dtype=np.float64).tobytes())
+        fingerprint.update(repr((self.timehorizon, float(self.end_level), self.tail_aggregation,
+                                 float(self.ppt.get_max_turb_power()),
+                                 float(self.ppt.get_max_pump_power()),
+                                 float(self.ppt.get_max_level()),
+                                 float(self.ppt.get_pump_efficiency()),
+                                 # Options like the kernel, the multigrid factor or the type of the profits
+                                 sorted(self.optimiser.get_result_options().items()))).encode())
+        return fingerprint.hexdigest()
+
+    def save_checkpoint(self, checkpoint_path, n_days):
+        """
+        Save the state of the power plant and of the market after the first n_days days.
+        The file is replaced at once, an interruption while saving keeps the previous checkpoint.
+        """
+        checkpoint = {'n_days': n_days, 'fingerprint': self.get_checkpoint_fingerprint()}
+        for key, value in self.ppt.state.get_checkpoint().items():
+            checkpoint["state_" + key] = value
+        for key, value in self.market.get_checkpoint().items():
+            checkpoint["market_" + key] = value
 
-            # Optimal Intraday 1 schedule
+        with open(checkpoint_path + ".tmp", "wb") as file:
+            np.savez_compressed(file, **checkpoint)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+    def load_checkpoint(self, checkpoint_path):
+        """
+        Restore the state of the power plant and of the market saved with save_checkpoint.
+
+        Returns
+        -------
+        The number of days already optimised
+        """
+        with np.load(checkpoint_path) as file:
+            checkpoint = dict(file)
+        if (str(checkpoint['fingerprint']) != self.get_checkpoint_fingerprint()):
+            raise ValueError("The checkpoint %s was saved with other prices or parameters" % checkpoint_path)
+
+        self.ppt.state.set_checkpoint({key[len("state_"):]: value for key, value in checkpoint.items()
+                                       if key.startswith("state_")})
+        self.market.set_checkpoint({key[len("market_"):]: value for key, value in checkpoint.items()
+                                    if key.startswith("market_")})
+        return int(checkpoint['n_days'])
+
+    def optimise_day(self, day_idx, day_id=None):
+        """
+        Optimise and execute one day, the day day_idx of the prices given with set_prices.
+        The transactions and the executed schedule are recorded as the day day_id, day_idx if None.
+        """
+        if (day_id is None):
+            day_id = day_idx
+        i = day_idx
+        instrumentation = self.instrumentation
+        instrumentation.start_day(day_id)
+
+        # The day ahead prices after the first day are the same for all market levels of the day,
+        # their optimisation is done only once
+        with instrumentation.stage("window"):
+            tail_prices, tail_step_durations = self.get_da_tail_prices(i, self.timehorizon)
+        with instrumentation.stage("tail"):
+            tail = self.optimiser.calculate_tail(tail_prices, self.end_level, tail_step_durations)
+
+        with instrumentation.stage("window"):
+            da_prices, step_durations = self.get_da_only_prices(i, 1)
             id_1_price, id_1_step_duration = self.get_da_and_id_prices(self.intraday_1_prices,
                                                                        self.intraday_1_time_step_duration,
-                                                                       i, self.timehorizon)
+                                                                       i, 1)
+            id_2_price, id_2_step_duration = self.get_da_and_id_prices(self.intraday_2_prices,
+                                                                       self.intraday_2_time_step_duration,
+                                                                       i, 1)
+
+        # The schedules of all market levels start from the same state, only the rolling depends on the order
+        opt_results_da = opt_results_id_1 = opt_results_id_2 = None
+        if (self.concurrent_solves):
+            with instrumentation.stage("solve_concurrent"):
+                opt_results_da, opt_results_id_1, opt_results_id_2 = self.calculate_optimal_schedules_concurrently(
+                    [(da_prices, step_durations), (id_1_price, id_1_step_duration),
+                     (id_2_price, id_2_step_duration)], tail)
+
+        # Optimal first transactions of day
+        last_optimal_schedule = self.calculate_schedule_da(da_prices, step_durations, day_id, tail, opt_results_da)
+
+        # Optimal Intraday 1 schedule
+        with instrumentation.stage("window"):
             # split da ahead periodes to be compatible with intraday 1
             last_optimal_schedule = self.split_first_day_periode(last_optimal_schedule)
-            last_optimal_schedule = self.calculate_schedule_id(id_1_price, id_1_step_duration, last_optimal_schedule, i, 1)
+        last_optimal_schedule = self.calculate_schedule_id(id_1_price, id_1_step_duration, last_optimal_schedule,
+                                                           day_id, 1, tail, opt_results_id_1)
 
-            id_2_price, id_2_step_duration = self.get_da_and_id_prices(self.intraday_2_prices,
-                                                                       self.intraday_2_time_step_duration,
-                                                                       i, self.timehorizon)
-            last_optimal_schedule = self.calculate_schedule_id(id_2_price, id_2_step_duration, last_optimal_schedule, i, 2)
+        # Optimal Intraday 2 schedule
+        last_optimal_schedule = self.calculate_schedule_id(id_2_price, id_2_step_duration, last_optimal_schedule,
+                                                           day_id, 2, tail, opt_results_id_2)
 
-            self.ppt.state.execute_schedule(id_2_price[0:self.n_step_id_day], i, last_optimal_schedule[0:self.n_step_id_day])
+        with instrumentation.stage("state_update"):
+            self.ppt.state.execute_schedule(id_2_price[0:self.n_step_id_day], day_id,
+                                            last_optimal_schedule[0:self.n_step_id_day])
+        instrumentation.end_day()
 
-        print("Done %i days calculated" % (number_of_days))
+    def optimise_stream(self, daily_prices, max_days=1):
+        """
+        Optimise the days one after the other as their prices arrive, for example from a live feed
+            or from a history too long to be loaded at once.
+        Only the prices of the current day and of the following timehorizon - 1 days are kept in memory.
+        Same results as optimise with the same prices.
+        Side effect: the power plant state and the market are cleared. The market keeps only the last max_days
+            days until it is cleared again with Market.clear. The max_days of the power plant state and the prices
+            given with set_prices are restored when the generator ends or is closed.
 
-    def calculate_schedule_da(self, prices, step_duration, day_id: int):
-        opt_results_da = self.optimiser.calculate_optimal_schedule(prices, self.ppt.state.energy_level,
-                                                                   self.ppt.state.last_action, self.end_level,
+        Parameters
+        ----------
+        daily_prices : iterable
+            (day ahead, intraday 1, intraday 2) prices of each day, in chronological order.
+            A day is optimised as soon as the prices of the following timehorizon - 1 days are known,
+            or when daily_prices ends.
+        max_days : int
+            Number of days kept in the history of the power plant state and of the market, None keeps all.
+
+        Returns
+        -------
+        generator of dict for each day with the day index ('day'), the executed schedule ('executed_schedule'),
+            its prices ('prices') and cashflow ('cashflow'), the cashflow of each market level
+            ('cashflow_da', 'cashflow_id_1', 'cashflow_id_2') and the energy level at the end of the day
+        """
+        previous_max_days = self.ppt.state.max_days
+        previous_prices = (getattr(self, 'day_ahead_prices', None), getattr(self, 'intraday_1_prices', None),
+                           getattr(self, 'intraday_2_prices', None))
+        self.ppt.state.max_days = max_days
+        self.ppt.state.clear()
+        self.market.clear(max_days)
+
+        try:
+            daily_prices = iter(daily_prices)
+            window = collections.deque()
+            day_id = 0
+            while (True):
+                for prices in daily_prices:
+                    window.append(tuple(np.ravel(day_prices) for day_prices in prices))
+                    if (len(window) >= self.timehorizon):
+                        break
+                if (len(window) == 0):
+                    break
+
+                self.set_prices(*[np.concatenate(market_prices) for market_prices in zip(*window)])
+                self.optimise_day(0, day_id)
+
+                state = self.ppt.state
+                yield {
+                    'day': day_id,
+                    'executed_schedule': state.get_last_day(state.executed_schedule_buffer).copy(),
+                    'prices': state.get_last_day(state.prices_buffer).copy(),
+                    'cashflow': state.get_last_day(state.cashflow_schedule_buffer).copy(),
+                    'cashflow_da': self.market.ledger_da.get_day(day_id).copy(),
+                    'cashflow_id_1': self.market.ledger_id_1.get_day(day_id).copy(),
+                    'cashflow_id_2': self.market.ledger_id_2.get_day(day_id).copy(),
+                    'energy_level': state.energy_level
+                }
+                window.popleft()
+                day_id += 1
+        finally:
+            self.ppt.state.max_days = previous_max_days
+            if (previous_prices[0] is not None):
+                self.set_prices(*previous_prices)
+
+    def calculate_optimal_schedule(self, prices, step_duration, tail=None):
+        """
+        Optimal schedule from the current state of the power plant.
+        If a tail from the optimiser is given, the prices are followed by the tail prices.
+        """
+        if (tail is None):
+            return self.optimiser.calculate_optimal_schedule(prices, self.ppt.state.energy_level,
+                                                             self.ppt.state.last_action, self.end_level,
+                                                             step_duration)
+        return self.optimiser.calculate_optimal_schedule_with_tail(prices, self.ppt.state.energy_level,
+                                                                   self.ppt.state.last_action, tail,
                                                                    step_duration)
-        best_schedule_da_sell = opt_results_da['sell_mwh'] - opt_results_da['buy_mwh']
 
-        self.market.do_transactions_da(prices[0:self.n_step_da_day], best_schedule_da_sell[0:self.n_step_da_day], day_id)
-        return best_schedule_da_sell
+    def calculate_optimal_schedules_concurrently(self, windows, tail=None):
+        """
+        Optimal schedules of several timeseries from the current state of the power plant, optimised at the same
+            time in threads (see concurrent_solves).
 
-    def calculate_schedule_id(self, prices, step_duration, last_optimal_schedule, day_id: int, id_type):
-        opt_results_id_1 = self.optimiser.calculate_optimal_schedule(prices, self.ppt.state.energy_level,
-                                                                     self.ppt.state.last_action, self.end_level,
-                                                                     step_duration)
-        best_schedule_id_1_sell = opt_results_id_1['sell_mwh'] - opt_results_id_1['buy_mwh']
+        Parameters
+        ----------
+        windows : list of tuple
+            (prices, step durations) of each timeserie.
+        tail : dict
+            Tail of the optimiser following all the timeseries, see calculate_optimal_schedule.
 
-        # Value if rolling
-        delta_transactions = best_schedule_id_1_sell - last_optimal_schedule
-        id_rolling_cashflow = self.market.calculate_cashflow(prices[0:self.n_step_id_day], delta_transactions[0:self.n_step_id_day])
-        if (np.sum(id_rolling_cashflow) > 0):
-            self.market.do_transactions_id(prices[0:self.n_step_id_day], delta_transactions[0:self.n_step_id_day], day_id, id_type)
+        Returns
+        -------
+        list with the results of the optimiser for each timeserie, in the order of windows
+        """
+        if (isinstance(self.optimiser, CachedScheduleOptimization)):
+            raise ValueError("CachedScheduleOptimization is not thread safe, it can not be used with concurrent_solves")
+        if (not self.can_solve_concurrently()):
+            return [self.calculate_optimal_schedule(prices, step_duration, tail) for prices, step_duration in windows]
 
-            # Update best schedule
-            last_optimal_schedule = best_schedule_id_1_sell
-        else:
-            self.market.do_transactions_id(prices[0:self.n_step_id_day], np.zeros(self.n_step_id_day), day_id, id_type)
+        with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+            futures = [executor.submit(self.calculate_optimal_schedule, prices, step_duration, tail)
+                       for prices, step_duration in windows]
+            return [future.result() for future in futures]
+
+    def can_solve_concurrently(self):
+        """
+        Tells if the optimiser can be called from several threads at the same time: not with the "gather" kernel,
+            and only with the tbb or omp threading layer of numba.
+        """
+        import numba
+
+        if (getattr(self.optimiser, "kernel", None) == "gather"):
+            return False
+        try:
+            threading_layer = numba.threading_layer()
+        except ValueError:  # No parallel compiled function was run yet
+            return False
+        return threading_layer in ("tbb", "omp")
+
+    def calculate_schedule_da(self, prices, step_duration, day_id: int, tail=None, opt_results_da=None):
+        """
+        Day ahead transactions of the day. The schedule is optimised, except if its results are given.
+        """
+        if (opt_results_da is None):
+            with self.instrumentation.stage("solve_da"):
+                opt_results_da = self.calculate_optimal_schedule(prices, step_duration, tail)
+        with self.instrumentation.stage("rolling"):
+            best_schedule_da_sell = opt_results_da['sell_mwh'] - opt_results_da['buy_mwh']
+
+            self.market.do_transactions_da(prices[0:self.n_step_da_day], best_schedule_da_sell[0:self.n_step_da_day], day_id)
+        return best_schedule_da_sell
+
+    def calculate_schedule_id(self, prices, step_duration, last_optimal_schedule, day_id: int, id_type, tail=None,
+                              opt_results_id_1=None):
+        """
+        Intraday transactions of the day, rolled from last_optimal_schedule when the new schedule is more profitable.
+        The schedule is optimised, except if its results are given.
+        """
+        if (opt_results_id_1 is None):
+            with self.instrumentation.stage("solve_id_%i" % id_type):
+                opt_results_id_1 = self.calculate_optimal_schedule(prices, step_duration, tail)
+        with self.instrumentation.stage("rolling"):
+            best_schedule_id_1_sell = opt_results_id_1['sell_mwh'] - opt_results_id_1['buy_mwh']
+
+            # Value if rolling
+            delta_transactions = best_schedule_id_1_sell - last_optimal_schedule
+            id_rolling_cashflow = self.market.calculate_cashflow(prices[0:self.n_step_id_day], delta_transactions[0:self.n_step_id_day])
+            if (np.sum(id_rolling_cashflow) > 0):
+                self.market.do_transactions_id(prices[0:self.n_step_id_day], delta_transactions[0:self.n_step_id_day], day_id, id_type)
+                self.instrumentation.count("rolled_id_%i" % id_type)
+
+                # Update best schedule
+                last_optimal_schedule = best_schedule_id_1_sell
+            else:
+                self.market.do_transactions_id(prices[0:self.n_step_id_day], np.zeros(self.n_step_id_day), day_id, id_type)
         return last_optimal_schedule
 
     def split_first_day_periode(self, prices):
         factor = int(self.day_ahead_time_step_duration / self.intraday_1_time_step_duration)
         da_periodes_in_day = int(self.hour_in_day / self.day_ahead_time_step_duration)
 
-        new_prices = []
-        for i in range(0, da_periodes_in_day):
-            for j in range(0, factor):
-                new_prices.append(prices[i] / factor)
-
-        return np.concatenate((new_prices, prices[da_periodes_in_day:]))
+        return np.concatenate((upsample_split(prices[0:da_periodes_in_day], factor), prices[da_periodes_in_day:]))
 
     def do_market_transactions(self, prices, buy, sell):
         """
@@ -259,6 +708,51 @@ class PumpStoragePlantIRMarketOptimiserNDays:
                                         np.ones(day_ahead_to - day_ahead_from) * self.day_ahead_time_step_duration))
         return price, step_duration
 
+    def get_da_tail_prices(self, day_idx, timeserie_length):
+        """
+        Prepare the day ahead timeserie of the days following the given day, up to timeserie_length days
+            from the given day, when available.
+        It is the end of the timeseries of get_da_only_prices and get_da_and_id_prices.
+
+        Parameters
+        ----------
+        day_idx : int
+            The index of the day from which to get the prices.
+        timeserie_length : int
+            The amount of days to get prices for, the given day included.
+
+        Returns
+        -------
+        day ahead prices and step duration
+        """
+        n_step_da = int(self.hour_in_day / self.day_ahead_time_step_duration)
+
+        day_ahead_to = min(int((day_idx + timeserie_length) * n_step_da), len(self.day_ahead_prices))
+        day_ahead_from = min(int((day_idx + 1) * n_step_da), len(self.day_ahead_prices))
+
+        prices = self.day_ahead_prices[day_ahead_from:day_ahead_to]
+        step_durations = np.ones(len(prices)) * self.day_ahead_time_step_duration
+        if (self.tail_aggregation is not None):
+            prices, step_durations = self.aggregate_tail(prices, step_durations)
+        return prices, step_durations
+
+    def aggregate_tail(self, prices, step_durations):
+        """
+        Merge the day ahead time steps of each day of the tail in longer time steps, see tail_aggregation.
+        The price of a merged time step is the mean of the prices, its duration the sum of the durations.
+        """
+        aggregated_prices = []
+        aggregated_step_durations = []
+        for day, day_from in enumerate(range(0, len(prices), self.n_step_da_day)):
+            day_to = day_from + self.n_step_da_day
+            block_duration = self.tail_aggregation[min(day, len(self.tail_aggregation) - 1)]
+            factor = max(1, int(round(block_duration / self.day_ahead_time_step_duration)))
+            aggregated_prices.append(downsample_mean(prices[day_from:day_to], factor))
+            aggregated_step_durations.append(downsample_sum(step_durations[day_from:day_to], factor))
+        if (len(aggregated_prices) == 0):
+            return prices, step_durations
+        return np.concatenate(aggregated_prices), np.concatenate(aggregated_step_durations)
+
     def get_da_only_prices(self, day_idx, timeserie_length):
         """
         Prepare the day ahead timeseries from the given day up to the following timeserie_length days, when available.
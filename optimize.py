@@ -1,5 +1,6 @@
 import numpy as np
 
+from instrumentation import NULL_INSTRUMENTATION
 from powerplant import IPumpStoragePlant
 
 
@@ -13,6 +14,8 @@ class IScheduleOptimization:
         self.ppt = ppt
         self.min_timestep = 0.25
         self.energy_lvl_step = self.get_possible_energy_level(self.min_timestep)
+        # Records timings and counters when set to an Instrumentation, see instrumentation.py
+        self.instrumentation = NULL_INSTRUMENTATION
 
     def calculate_optimal_schedule(self,
                                    electricity_price: list[float],
@@ -45,6 +48,59 @@ class IScheduleOptimization:
         """
         pass
 
+    def calculate_tail(self,
+                       electricity_price: list[float],
+                       final_energy_level: float,
+                       mw_to_mwh_factors: list[float]):
+        """
+        Prepare the end of a timeserie that is shared by several schedules.
+        Some optimisers can precalculate the value of each energy level at the start of the tail,
+            this default implementation only keeps the prices.
+
+        Parameters
+        ----------
+        electricity_price : list of float
+            The electricity price for each timestep of the tail.
+        final_energy_level : float
+            The energy level at the end of the tail.
+        mw_to_mwh_factors : list of float
+            The factor to convert MW to MWh for each timestep of the tail.
+
+        Returns
+        -------
+        dict to give to calculate_optimal_schedule_with_tail
+        """
+        return {
+            'prices': electricity_price,
+            'mw_to_mwh_factors': mw_to_mwh_factors,
+            'final_energy_level': final_energy_level
+        }
+
+    def calculate_optimal_schedule_with_tail(self,
+                                             electricity_price: list[float],
+                                             initial_energy_level: float,
+                                             previous_last_action: int,
+                                             tail: dict,
+                                             mw_to_mwh_factors: list[float]):
+        """
+        Same as calculate_optimal_schedule for the timeserie electricity_price followed by the tail.
+        The tail is the result of calculate_tail.
+        The results cover the full timeserie, tail included.
+        """
+        return self.calculate_optimal_schedule(np.concatenate((electricity_price, tail['prices'])),
+                                               initial_energy_level,
+                                               previous_last_action,
+                                               tail['final_energy_level'],
+                                               np.concatenate((mw_to_mwh_factors, tail['mw_to_mwh_factors'])))
+
+    def get_result_options(self):
+        """
+        Name of the optimiser and its options that change the results, used in the keys of the schedule cache
+            and in the fingerprint of the checkpoints.
+        Optimisers with options add them to this dict.
+        """
+        return {'optimiser': type(self).__name__, 'energy_lvl_step': float(self.energy_lvl_step)}
+
     def get_possible_energy_level(self, min_timestep):
         """
         Finde a goold value for the energy level step.
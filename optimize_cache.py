@@ -0,0 +1,218 @@
+import collections
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from optimize import IScheduleOptimization
+
+
+class CachedScheduleOptimization(IScheduleOptimization):
+    """
+    Cache of the results of another schedule optimiser.
+    The inputs of each optimisation are hashed, an optimisation already done with the same inputs
+        returns the saved results without optimising again.
+    The least recently used results are removed when the cache is bigger than max_bytes.
+    With a cache directory, the results are also saved on disk and reused by the next runs.
+    """
+
+    def __init__(self, optimiser: IScheduleOptimization, max_bytes: int = 256 * 1024 * 1024,
+                 cache_directory: str = None):
+        """
+        Parameters
+        ----------
+        optimiser : IScheduleOptimization
+            The optimiser used when the results are not in the cache
+        max_bytes : int
+            Maximum size of the arrays kept in memory
+        cache_directory : str
+            If given, the schedules are also saved in this directory, one .npz file per schedule.
+            The tails (calculate_tail) are only kept in memory.
+        """
+        self.optimiser = optimiser
+        # The base class resets the instrumentation through the property, keep the one of the wrapped optimiser
+        instrumentation = optimiser.instrumentation
+        super().__init__(optimiser.ppt)
+        self.instrumentation = instrumentation
+        self.max_bytes = max_bytes
+        self.cache_directory = cache_directory
+        if (cache_directory is not None):
+            os.makedirs(cache_directory, exist_ok=True)
+
+        self.entries = collections.OrderedDict()  # key -> (results, size in bytes), least recently used first
+        self.n_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def ppt(self):
+        return self.optimiser.ppt
+
+    @ppt.setter
+    def ppt(self, ppt):
+        self.optimiser.ppt = ppt
+
+    @property
+    def instrumentation(self):
+        return self.optimiser.instrumentation
+
+    @instrumentation.setter
+    def instrumentation(self, instrumentation):
+        self.optimiser.instrumentation = instrumentation
+
+    def calculate_optimal_schedule(self,
+                                   electricity_price: list[float],
+                                   initial_energy_level: float,
+                                   previous_last_action: int,
+                                   final_energy_level: float,
+                                   mw_to_mwh_factors: list[float]):
+        """
+        Results of the optimiser, from the cache if it already optimised the same inputs.
+        For more informations, see documentation of parent class.
+        """
+        key = self.get_key("schedule", electricity_price, mw_to_mwh_factors, initial_energy_level,
+                           previous_last_action, final_energy_level)
+        results = self.get(key)
+        if (results is None):
+            results = self.optimiser.calculate_optimal_schedule(electricity_price, initial_energy_level,
+                                                                previous_last_action, final_energy_level,
+                                                                mw_to_mwh_factors)
+            self.put(key, results)
+        return dict(results)
+
+    def calculate_tail(self,
+                       electricity_price: list[float],
+                       final_energy_level: float,
+                       mw_to_mwh_factors: list[float]):
+        """
+        The tail of the optimiser is only calculated when a schedule with this tail is not in the cache.
+        For more informations, see documentation of parent class.
+        """
+        tail = super().calculate_tail(electricity_price, final_energy_level, mw_to_mwh_factors)
+        tail['key'] = self.get_key("tail", electricity_price, mw_to_mwh_factors, final_energy_level)
+        tail['optimiser_tail'] = None
+        return tail
+
+    def calculate_optimal_schedule_with_tail(self,
+                                             electricity_price: list[float],
+                                             initial_energy_level: float,
+                                             previous_last_action: int,
+                                             tail: dict,
+                                             mw_to_mwh_factors: list[float]):
+        """
+        Results of the optimiser, from the cache if it already optimised the same inputs and tail.
+        For more informations, see documentation of parent class.
+        """
+        key = self.get_key("schedule_with_tail", electricity_price, mw_to_mwh_factors, initial_energy_level,
+                           previous_last_action, tail['key'])
+        results = self.get(key)
+        if (results is None):
+            if (tail['optimiser_tail'] is None):
+                tail['optimiser_tail'] = self.get(tail['key'], on_disk=False, count=False)
+            if (tail['optimiser_tail'] is None):
+                tail['optimiser_tail'] = self.optimiser.calculate_tail(tail['prices'], tail['final_energy_level'],
+                                                                       tail['mw_to_mwh_factors'])
+                self.put(tail['key'], tail['optimiser_tail'], on_disk=False)
+            results = self.optimiser.calculate_optimal_schedule_with_tail(electricity_price, initial_energy_level,
+                                                                          previous_last_action,
+                                                                          tail['optimiser_tail'],
+                                                                          mw_to_mwh_factors)
+            self.put(key, results)
+        return dict(results)
+
+    def get_result_options(self):
+        """Options of the wrapped optimiser, the cache does not change the results."""
+        return self.optimiser.get_result_options()
+
+    def get_key(self, kind, prices, mw_to_mwh_factors, *values):
+        """
+        Hash of the inputs of an optimisation, of the power plant and of the parameters of the optimiser.
+        """
+        key = hashlib.sha1()
+        key.update(repr((kind,
+                         self.ppt.get_max_turb_power(),
+                         self.ppt.get_max_pump_power(),
+                         self.ppt.get_max_level(),
+                         self.ppt.get_pump_efficiency(),
+                         # Options like the kernel, the multigrid factor or the type of the profits
+                         sorted(self.get_result_options().items()),
+                         [float(value) if not isinstance(value, str) else value for value in values])).encode())
+        key.update(np.ascontiguousarray(prices, dtype=np.float64).tobytes())
+        key.update(np.ascontiguousarray(mw_to_mwh_factors, dtype=np.float64).tobytes())
+        return key.hexdigest()
+
+    def get(self, key, on_disk=True, count=True):
+        """
+        Results saved with the key, None if they are not in the cache.
+        count tells if the request is counted in the statistics.
+        """
+        if (key in self.entries):
+            self.entries.move_to_end(key)
+            self.hits += count
+            return self.entries[key][0]
+
+        if (on_disk and self.cache_directory is not None):
+            path = os.path.join(self.cache_directory, key + ".npz")
+            if (os.path.exists(path)):
+                with np.load(path) as file:
+                    results = {name: file[name] if file[name].ndim > 0 else file[name][()] for name in file.files}
+                self.disk_hits += count
+                self.put(key, results, on_disk=False)
+                return results
+
+        self.misses += count
+        return None
+
+    def put(self, key, results, on_disk=True):
+        """
+        Save the results with the key, remove the least recently used results when the cache is full.
+        """
+        size = sum(value.nbytes for value in results.values() if isinstance(value, np.ndarray))
+        if (size > self.max_bytes):
+            return
+        # Results saved again with the same key replace the previous ones
+        previous = self.entries.pop(key, None)
+        if (previous is not None):
+            self.n_bytes -= previous[1]
+        self.entries[key] = (results, size)
+        self.n_bytes += size
+        while (self.n_bytes > self.max_bytes):
+            removed_key, (removed_results, removed_size) = self.entries.popitem(last=False)
+            self.n_bytes -= removed_size
+
+        if (on_disk and self.cache_directory is not None):
+            path = os.path.join(self.cache_directory, key + ".npz")
+            # Written to a temporary file of this process first, other processes never read half written files
+            file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_directory)
+            try:
+                with os.fdopen(file_descriptor, "wb") as file:
+                    np.savez(file, **results)
+                os.replace(temporary_path, path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+
+    def clear(self):
+        """
+        Remove all the results from memory, the files of the cache directory are kept.
+        """
+        self.entries.clear()
+        self.n_bytes = 0
+
+    def get_statistics(self):
+        """
+        Returns
+        -------
+        dict with the number of hits in memory and on disk, of misses, the hit rate and the size of the cache
+        """
+        n_requests = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / n_requests if n_requests > 0 else 0,
+            'entries': len(self.entries),
+            'bytes': self.n_bytes
+        }
@@ -1,14 +1,117 @@
+import warnings
+
 import numpy as np
 
 from optimize import IScheduleOptimization
 from powerplant import IPumpStoragePlant
 
-from numba import jit
+from numba import jit, prange, boolean, float32, float64, int8, int64, uint8
+
+# Signatures of the compiled functions called from python.
+# With explicit signatures, the functions are compiled when the module is imported,
+# and with cache=True the compiled code is saved in __pycache__ and reused by the next processes.
+BUILD_MATRIX_SIGNATURE = (float64[:], int64, int64, int64, float64[:], float64, float64, float64, float64)
+BUILD_MATRIX_TERMINAL_SIGNATURE = (float64[:], float64[:], int8[:], int64, float64[:], float64, float64, float64,
+                                   float64)
+BUILD_MATRIX_TERMINAL_FLOAT32_SIGNATURE = (float64[:], float32[:], int8[:], int64, float64[:], float64, float64,
+                                           float64, float64)
+BATCH_SIGNATURE = (float64[:, :], int64, int64, int64, int64, float64[:], float64, float64, float64, float64, float64,
+                   float64)
+BUILD_MATRIX_BAND_SIGNATURE = (float64[:], float64[:], int64[:], int64[:], float64[:], int64[:], int64[:], int64, int8[:])
+REACHABLE_BAND_SIGNATURE = (float64[:], float64[:], int64, float64, float64, float64, float64)
+CHECKPOINTS_SIGNATURE = (float64[:], float64[:], int8[:], int64, float64[:], int64, float64, float64, float64, float64)
+BACKTRACK_CHECKPOINTED_SIGNATURE = (float64[:, :], int8[:, :], float64[:], int64, float64[:], int64, int64, float64,
+                                    float64, float64, float64, float64, float64)
+BACKTRACK_SIGNATURES = [(decisions_type, boolean, int64, float64[:], float64, float64, float64, float64, float64)
+                        for decisions_type in (int8[:, :], uint8[:, :])]
+
+
+def as_kernel_array(values, dtype=np.float64):
+    """
+    Array to give to the compiled functions, their signatures only accept writeable arrays.
+    Read only arrays, like the memory mapped prices of input.get_price_data_memmap, are copied.
+    """
+    array = np.asarray(values, dtype=dtype)
+    if (not array.flags['WRITEABLE']):
+        array = array.copy()
+    return array
 
 
 class DynamicProgrammingOptimisation(IScheduleOptimization):
-    def __init__(self, ppt: IPumpStoragePlant):
+    def __init__(self,
+                 ppt: IPumpStoragePlant,
+                 packed_decisions: bool = False,
+                 multigrid_factor: int = 1,
+                 multigrid_band: int = None,
+                 multigrid_tolerance: float = None,
+                 kernel: str = "scatter",
+                 reachability_pruning: bool = True,
+                 decision_memory_budget: int = 512 * 1024 * 1024,
+                 value_dtype=np.float64):
+        """
+        Parameters
+        ----------
+        ppt : IPumpStoragePlant
+            The pump storage plant to optimise
+        packed_decisions : bool
+            If True, the decision matrix is stored with 2 bits per decision instead of one int8.
+            Uses 4 times less memory, but is a bit slower.
+        multigrid_factor : int
+            If bigger than 1, the schedule is first optimised on a coarse grid of energy levels with a step
+            multigrid_factor times bigger. The fine grid is then only optimised in a band around the coarse schedule.
+            Much faster for big reservoirs, but the result can be a bit less profitable than the exact optimisation.
+        multigrid_band : int
+            Half width of the band in number of fine energy levels.
+            If None, twice the biggest change in energy level of a time step on the coarse grid.
+        multigrid_tolerance : float
+            The band is doubled while the schedule touches its border. If given, the doubling stops as soon as
+            the relative profit gain of a doubling is smaller than multigrid_tolerance.
+        kernel : str
+            "scatter": each energy level writes its profit into the levels it can come from, single thread.
+            "gather": each energy level reads the profit of the levels it can go to, parallel over the energy levels.
+            Both give the same result, "gather" is faster for big reservoirs on many cpus.
+            Only used with int8 decisions, packed decisions always use "scatter".
+        reachability_pruning : bool
+            If True, each time step only visits the energy levels that can be reached from the initial energy level
+                and that can still reach the final energy level. Same schedule and profit, much faster for short
+                timeseries on big reservoirs.
+            Only used with the "scatter" kernel and int8 decisions.
+        decision_memory_budget : int
+            Maximum size in bytes of a decision matrix, see get_decision_matrix_size.
+            Bigger schedules are optimised without decision matrix: the profits are only kept at sqrt(T) time steps
+                and the decisions are computed again segment by segment while reading the schedule.
+                Uses O(sqrt(T) * N) memory instead of O(T * N), but the dynamic programming is done twice.
+            Same schedule and profit. No limit if None. Not used with the multigrid.
+            Over the budget, kernel, packed_decisions, reachability_pruning and value_dtype are not used:
+                the checkpoints are computed like the "scatter" kernel with float64 profits, on all the energy levels.
+        value_dtype : np.float64 or np.float32
+            Type of the profits in the "scatter" kernel with int8 decisions, when the energy levels are not pruned.
+            With reachability_pruning, the profits are always float64, also when all the energy levels are reachable.
+            float32 halves the memory read and written at each time step. The profits are rounded to about
+                7 significant digits, so the schedule can differ where two decisions are almost as profitable.
+                Tolerance against float64: the profits stay within 1e-6 of the largest profit (5e-7 measured
+                on one week windows of Limmern, Hongrin and a 500 GWh reservoir), and the rolling optimisation
+                of price.mat gave the same schedules.
+            A warning is given when float32 is not used: with packed decisions, the "gather" kernel,
+                the reachability pruning, the multigrid or over the decision_memory_budget.
+        """
+        if (kernel not in ("scatter", "gather")):
+            raise ValueError("Unknown kernel %s, use scatter or gather" % kernel)
+        if (np.dtype(value_dtype) not in (np.float64, np.float32)):
+            raise ValueError("Unknown value type %s, use np.float64 or np.float32" % value_dtype)
         super().__init__(ppt)
+        self.kernel = kernel
+        self.packed_decisions = packed_decisions
+        self.multigrid_factor = multigrid_factor
+        self.multigrid_band = multigrid_band
+        self.multigrid_tolerance = multigrid_tolerance
+        self.reachability_pruning = reachability_pruning
+        self.decision_memory_budget = decision_memory_budget
+        self.value_dtype = np.dtype(value_dtype)
+        if (self.value_dtype == np.float32
+                and (packed_decisions or kernel != "scatter" or reachability_pruning or multigrid_factor > 1)):
+            warnings.warn("value_dtype float32 is only used by the scatter kernel with int8 decisions, without "
+                          "reachability pruning and multigrid, the profits are computed with float64")
         self.n_energy_levels = int((self.ppt.get_max_level() / self.energy_lvl_step) + 1)
         self.delta_lvl_pump = +self.ppt.get_max_pump_power() * self.ppt.get_pump_efficiency() / self.energy_lvl_step
         self.delta_lvl_turb = -self.ppt.get_max_turb_power() / self.energy_lvl_step
@@ -18,6 +121,21 @@ class DynamicProgrammingOptimisation(IScheduleOptimization):
         print("number steps pump: " + str(self.delta_lvl_pump))
         print("number steps turb: " + str(self.delta_lvl_turb))
 
+    def get_result_options(self):
+        """
+        Name of the optimiser and its options, see documentation of parent class.
+        """
+        options = super().get_result_options()
+        options.update({'kernel': self.kernel,
+                        'packed_decisions': bool(self.packed_decisions),
+                        'multigrid_factor': self.multigrid_factor,
+                        'multigrid_band': self.multigrid_band,
+                        'multigrid_tolerance': self.multigrid_tolerance,
+                        'reachability_pruning': bool(self.reachability_pruning),
+                        'decision_memory_budget': self.decision_memory_budget,
+                        'value_dtype': self.value_dtype.name})
+        return options
+
     def calculate_optimal_schedule(self,
                                    prices: list[float],
                                    initial_energy_lvl: float,
@@ -29,35 +147,483 @@ class DynamicProgrammingOptimisation(IScheduleOptimization):
         For more informations, see documentation of parent class.
         """
         final_energy_lvl = int(final_energy_lvl / self.energy_lvl_step)
-        profits, decisions = self.build_matrix(prices, self.n_energy_levels, previous_last_action, final_energy_lvl,
-                                               mw_to_mwh_factors)
-        sell_mwh = np.zeros(len(prices))
-        buy_mwh = np.zeros(len(prices))
-
-        energy_lvl = [0 for i in range(len(prices) + 1)]
-        energy_lvl[0] = int(initial_energy_lvl / self.energy_lvl_step)
-        for i in range(0, len(prices), 1):
-            action = decisions[i][energy_lvl[i]]
-            if (action == 0):
-                sell_mwh[i] = 0
-                buy_mwh[i] = 0
-                energy_lvl[i + 1] = energy_lvl[i]
-            elif (action == 1):
-                sell_mwh[i] = 0
-                buy_mwh[i] = self.ppt.get_max_pump_power() * mw_to_mwh_factors[i]
-                energy_lvl[i + 1] = int(energy_lvl[i] + mw_to_mwh_factors[i] * self.delta_lvl_pump)
-            elif (action == -1):
-                sell_mwh[i] = self.ppt.get_max_turb_power() * mw_to_mwh_factors[i]
-                buy_mwh[i] = 0
-                energy_lvl[i + 1] = int(energy_lvl[i] + mw_to_mwh_factors[i] * self.delta_lvl_turb)
+        initial_energy_lvl = int(initial_energy_lvl / self.energy_lvl_step)
+        if (self.multigrid_factor == 1 and self.use_checkpointed_backtracking(len(prices))):
+            results, _ = self.calculate_optimal_schedule_checkpointed(prices, initial_energy_lvl, previous_last_action,
+                                                                      get_terminal_values(self.n_energy_levels,
+                                                                                          final_energy_lvl),
+                                                                      mw_to_mwh_factors)
+            return results
+
+        self.count_solve(len(prices))
+        with self.instrumentation.stage("dp"):
+            if (self.multigrid_factor > 1):
+                profits, decisions = self.build_matrix_multigrid(prices, initial_energy_lvl, previous_last_action,
+                                                                 final_energy_lvl, mw_to_mwh_factors)
+                packed = False
+            elif (self.use_reachability_pruning()):
+                profits, decisions = self.build_matrix_reachable(prices, initial_energy_lvl, previous_last_action,
+                                                                 get_terminal_values(self.n_energy_levels,
+                                                                                     final_energy_lvl),
+                                                                 mw_to_mwh_factors)
+                packed = False
+            else:
+                profits, decisions = self.build_matrix(prices, self.n_energy_levels, previous_last_action,
+                                                       final_energy_lvl, mw_to_mwh_factors)
+                packed = self.packed_decisions
+        sell_mwh, buy_mwh, hourly_energy_level, _ = self.backtrack(decisions, initial_energy_lvl, mw_to_mwh_factors,
+                                                                   packed)
+
+        return {
+            'total_cashflow': profits[initial_energy_lvl],
+            'sell_mwh': sell_mwh,
+            'buy_mwh': buy_mwh,
+            'hourly_energy_level': hourly_energy_level
+        }
+
+    def calculate_tail(self,
+                       prices: list[float],
+                       final_energy_lvl: float,
+                       mw_to_mwh_factors: list[float]):
+        """
+        Backward pass over the end of a timeserie, done once and shared by several schedules.
+        For more informations, see documentation of parent class.
+
+        Returns
+        -------
+        dict with the prices and step sizes of the tail, the profit for each energy level at the start of the tail
+            ('terminal_values') and the decision matrix of the tail
+        """
+        if (self.multigrid_factor > 1 or self.use_checkpointed_backtracking(len(prices))):
+            # The multigrid optimisation needs a single final energy level,
+            # and a tail too big for the memory budget can not keep its decision matrix
+            return super().calculate_tail(prices, final_energy_lvl, mw_to_mwh_factors)
+
+        final_energy_lvl = int(final_energy_lvl / self.energy_lvl_step)
+        # The first action of the tail is not the first action of the schedule, no restriction on the last action
+        self.count_solve(len(prices))
+        with self.instrumentation.stage("dp"):
+            if (self.use_reachability_pruning()):
+                # All the energy levels at the start of the tail are needed, only the final energy level prunes
+                profits, decisions = self.build_matrix_reachable(prices, -1, 0,
+                                                                 get_terminal_values(self.n_energy_levels,
+                                                                                     final_energy_lvl),
+                                                                 mw_to_mwh_factors)
+            else:
+                profits, decisions = self.build_matrix(prices, self.n_energy_levels, 0, final_energy_lvl,
+                                                       mw_to_mwh_factors)
+        return {
+            'prices': prices,
+            'mw_to_mwh_factors': mw_to_mwh_factors,
+            'terminal_values': profits,
+            'decisions': decisions
+        }
+
+    def calculate_optimal_schedule_with_tail(self,
+                                             prices: list[float],
+                                             initial_energy_lvl: float,
+                                             previous_last_action: int,
+                                             tail: dict,
+                                             mw_to_mwh_factors: list[float]):
+        """
+        Optimisation of the timeserie prices followed by a tail calculated with calculate_tail.
+        Only the prices before the tail are optimised, the result is the same as calculate_optimal_schedule
+            on the full timeserie.
+        """
+        if ('terminal_values' not in tail):
+            return super().calculate_optimal_schedule_with_tail(prices, initial_energy_lvl, previous_last_action,
+                                                                tail, mw_to_mwh_factors)
+
+        if (self.packed_decisions):
+            terminal_decisions = unpack_decision_row(tail['decisions'], 0, self.n_energy_levels)
+        else:
+            terminal_decisions = tail['decisions'][0]
+
+        initial_energy_lvl = int(initial_energy_lvl / self.energy_lvl_step)
+        opt_results, head_final_lvl = self.calculate_optimal_schedule_terminal_values(prices,
+                                                                                      initial_energy_lvl,
+                                                                                      previous_last_action,
+                                                                                      tail['terminal_values'],
+                                                                                      mw_to_mwh_factors,
+                                                                                      terminal_decisions)
+        sell_mwh, buy_mwh, hourly_energy_level, _ = self.backtrack(tail['decisions'], head_final_lvl,
+                                                                   tail['mw_to_mwh_factors'])
+
+        return {
+            'total_cashflow': opt_results['total_cashflow'],
+            'sell_mwh': np.concatenate((opt_results['sell_mwh'], sell_mwh)),
+            'buy_mwh': np.concatenate((opt_results['buy_mwh'], buy_mwh)),
+            'hourly_energy_level': np.concatenate((opt_results['hourly_energy_level'], hourly_energy_level))
+        }
+
+    def calculate_optimal_schedule_terminal_values(self,
+                                                   prices: list[float],
+                                                   initial_energy_lvl: int,
+                                                   previous_last_action: int,
+                                                   terminal_values,
+                                                   mw_to_mwh_factors: list[float],
+                                                   terminal_decisions=None):
+        """
+        Same as calculate_optimal_schedule, but the end of the schedule is valued with a precomputed profit
+            for each energy level instead of a single final energy level.
+
+        Parameters
+        ----------
+        initial_energy_lvl : int
+            Index of the initial energy level.
+        terminal_values : np.array
+            Profit for each energy level index at the end of the schedule, -inf if the level is not allowed.
+        terminal_decisions : np.array
+            Decisions (-1, 0 or 1) right after the end of the schedule for each energy level index, they restrict
+            the last action of the schedule. No restriction if None.
+
+        Returns
+        -------
+        The optimisation results, and the index of the energy level at the end of the schedule.
+        """
+        if (terminal_decisions is None):
+            terminal_decisions = np.zeros(self.n_energy_levels, dtype=np.int8)
+        if (self.use_checkpointed_backtracking(len(prices))):
+            return self.calculate_optimal_schedule_checkpointed(prices, initial_energy_lvl, previous_last_action,
+                                                                terminal_values, mw_to_mwh_factors,
+                                                                terminal_decisions)
+
+        self.count_solve(len(prices))
+        with self.instrumentation.stage("dp"):
+            if (self.use_reachability_pruning()):
+                profits, decisions = self.build_matrix_reachable(prices, initial_energy_lvl, previous_last_action,
+                                                                 terminal_values, mw_to_mwh_factors,
+                                                                 terminal_decisions)
+            else:
+                profits, decisions = self.build_matrix_terminal(prices, terminal_values, terminal_decisions,
+                                                                previous_last_action, mw_to_mwh_factors)
+        sell_mwh, buy_mwh, hourly_energy_level, final_energy_lvl = self.backtrack(decisions, initial_energy_lvl,
+                                                                                   mw_to_mwh_factors)
+
+        return {
+            'total_cashflow': profits[initial_energy_lvl],
+            'sell_mwh': sell_mwh,
+            'buy_mwh': buy_mwh,
+            'hourly_energy_level': hourly_energy_level
+        }, final_energy_lvl
+
+    def calculate_optimal_schedule_checkpointed(self,
+                                                prices: list[float],
+                                                initial_energy_lvl: int,
+                                                previous_last_action: int,
+                                                terminal_values,
+                                                mw_to_mwh_factors: list[float],
+                                                terminal_decisions=None):
+        """
+        Same as calculate_optimal_schedule_terminal_values, without keeping the decision matrix in memory.
+        The backward pass keeps the profits and the decisions every sqrt(T) time steps (checkpoints).
+        The schedule is then read segment by segment: the decisions of a segment are computed again
+            from the checkpoint at its end.
+        """
+        if (terminal_decisions is None):
+            terminal_decisions = np.zeros(self.n_energy_levels, dtype=np.int8)
+        if (self.value_dtype == np.float32):
+            warnings.warn("value_dtype float32 is not used over the decision_memory_budget, "
+                          "the checkpoints are computed with float64")
+        segment_length = self.get_checkpoint_segment_length(len(prices))
+        prices = as_kernel_array(prices)
+        mw_to_mwh_factors = as_kernel_array(mw_to_mwh_factors)
+
+        self.count_solve(len(prices))
+        self.instrumentation.count("dp_checkpointed_solves")
+        with self.instrumentation.stage("dp"):
+            checkpoint_profits, checkpoint_decisions = build_checkpoints(prices,
+                                                                         as_kernel_array(terminal_values),
+                                                                         as_kernel_array(terminal_decisions, np.int8),
+                                                                         int(previous_last_action),
+                                                                         mw_to_mwh_factors,
+                                                                         segment_length,
+                                                                         *self.get_kernel_parameters())
+        with self.instrumentation.stage("backtrack"):
+            sell_mwh, buy_mwh, hourly_energy_level, final_energy_lvl = backtrack_checkpointed(
+                checkpoint_profits,
+                checkpoint_decisions,
+                prices,
+                int(previous_last_action),
+                mw_to_mwh_factors,
+                segment_length,
+                int(initial_energy_lvl),
+                *self.get_kernel_parameters(),
+                float(self.delta_lvl_pump),
+                float(self.delta_lvl_turb))
+
+        return {
+            'total_cashflow': checkpoint_profits[0, initial_energy_lvl],
+            'sell_mwh': sell_mwh,
+            'buy_mwh': buy_mwh,
+            'hourly_energy_level': hourly_energy_level
+        }, final_energy_lvl
+
+    def use_checkpointed_backtracking(self, n_steps: int):
+        """Tells if the decision matrix of a timeserie of n_steps is bigger than the memory budget."""
+        return (self.decision_memory_budget is not None
+                and self.get_decision_matrix_size(n_steps) > self.decision_memory_budget)
+
+    def get_checkpoint_segment_length(self, n_steps: int):
+        """Number of time steps between two checkpoints, sqrt(n_steps) minimises the memory."""
+        return max(1, int(np.ceil(np.sqrt(n_steps))))
+
+    def get_checkpointed_memory_size(self, n_steps: int):
+        """
+        Size in bytes of the checkpoints (profits and decisions), of the decisions of one segment,
+            of the two rows of profits and of decisions of the backward pass and of the cashflows and changes
+            in energy level of each time step of calculate_optimal_schedule_checkpointed for a timeserie of n_steps.
+        """
+        segment_length = self.get_checkpoint_segment_length(n_steps)
+        n_checkpoints = (n_steps + segment_length - 1) // segment_length + 1
+        return (n_checkpoints * 9 + segment_length + 1 + 2 * 9) * self.n_energy_levels + 4 * 8 * n_steps
+
+    def backtrack(self, decisions, initial_energy_lvl: int, mw_to_mwh_factors: list[float], packed: bool = None):
+        """
+        Read the schedule from the decision matrix, starting at the initial energy level index.
+        packed tells if the decision matrix is packed, self.packed_decisions if None.
+        """
+        if (packed is None):
+            packed = self.packed_decisions
+        with self.instrumentation.stage("backtrack"):
+            return backtrack_schedule(decisions,
+                                      packed,
+                                      int(initial_energy_lvl),
+                                      as_kernel_array(mw_to_mwh_factors),
+                                      float(self.ppt.get_max_pump_power()),
+                                      float(self.ppt.get_max_turb_power()),
+                                      float(self.delta_lvl_pump),
+                                      float(self.delta_lvl_turb),
+                                      float(self.energy_lvl_step))
+
+    def count_solve(self, n_steps: int):
+        """Counters of the instrumentation for one decision matrix of n_steps time steps."""
+        self.instrumentation.count("dp_solves")
+        self.instrumentation.count("dp_steps", n_steps)
+        self.instrumentation.count("dp_cells", n_steps * self.n_energy_levels)
+        self.instrumentation.set("n_energy_levels", self.n_energy_levels)
+
+    def get_multigrid_profit_gap(self,
+                                 prices: list[float],
+                                 initial_energy_lvl: float,
+                                 previous_last_action: int,
+                                 final_energy_lvl: float,
+                                 mw_to_mwh_factors: list[float]):
+        """
+        Optimise the schedule with the multigrid and the exact optimisation, to measure the loss of the multigrid.
+        The gap can be slightly negative: with the pause between pumping and turbining, the exact optimisation
+            is not always the best schedule either.
+
+        Returns
+        -------
+        dict with the profit of the exact optimisation, the profit of the multigrid optimisation
+            and the relative profit gap
+        """
+        multigrid_factor = self.multigrid_factor
+        try:
+            self.multigrid_factor = 1
+            exact = self.calculate_optimal_schedule(prices, initial_energy_lvl, previous_last_action,
+                                                    final_energy_lvl, mw_to_mwh_factors)
+        finally:
+            self.multigrid_factor = multigrid_factor
+        multigrid = self.calculate_optimal_schedule(prices, initial_energy_lvl, previous_last_action,
+                                                    final_energy_lvl, mw_to_mwh_factors)
 
+        profit_gap = exact['total_cashflow'] - multigrid['total_cashflow']
         return {
-            'total_cashflow': profits[energy_lvl[0]],
+            'exact_cashflow': exact['total_cashflow'],
+            'multigrid_cashflow': multigrid['total_cashflow'],
+            'relative_profit_gap': profit_gap / abs(exact['total_cashflow']) if exact['total_cashflow'] != 0 else 0
+        }
+
+    def get_step_deltas(self, prices: list[float], mw_to_mwh_factors: list[float]):
+        """
+        Cashflow and change of energy level index when pumping and turbining for each time step.
+        The changes in energy level are from the future to the past, like in the backward optimisation.
+        Same values than in calculate_step_deltas.
+        """
+        pump_power, turb_power, pump_efficiency, energy_lvl_step = self.get_kernel_parameters()
+        prices = as_kernel_array(prices)
+        mw_to_mwh_factors = as_kernel_array(mw_to_mwh_factors)
+
+        cash_delta_pump = -pump_power * mw_to_mwh_factors * prices
+        cash_delta_turb = +turb_power * mw_to_mwh_factors * prices
+        lvl_delta_pump = -(pump_power * pump_efficiency * mw_to_mwh_factors / energy_lvl_step).astype(np.int64)
+        lvl_delta_turb = +(turb_power * mw_to_mwh_factors / energy_lvl_step).astype(np.int64)
+        return cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb
+
+    def use_reachability_pruning(self):
+        """Tells if the decision matrices are built with build_matrix_reachable."""
+        return self.reachability_pruning and self.kernel == "scatter" and not self.packed_decisions
+
+    def build_matrix_reachable(self,
+                               prices: list[float],
+                               initial_energy_lvl: int,
+                               previous_last_action: int,
+                               terminal_values,
+                               mw_to_mwh_factors: list[float],
+                               terminal_decisions=None):
+        """
+        Create a decision matrix where each time step only visits the energy levels that are reachable
+            from the initial energy level index and from which a finite terminal value is reachable.
+        With an initial energy level index of -1, all the energy levels at the start are kept.
+        The profit and the decisions are the same as build_matrix_terminal for every energy level visited
+            by a schedule starting at the initial energy level, the other energy levels can have a profit of -inf.
+        """
+        if (terminal_decisions is None):
+            terminal_decisions = np.zeros(self.n_energy_levels, dtype=np.int8)
+        terminal_values = as_kernel_array(terminal_values)
+        band_low, band_high = get_reachable_band(as_kernel_array(mw_to_mwh_factors), terminal_values,
+                                                 int(initial_energy_lvl), *self.get_kernel_parameters())
+        n_band_cells = np.sum(np.maximum(band_high - band_low + 1, 0))
+        if (n_band_cells > 0.75 * len(band_low) * self.n_energy_levels):
+            # Almost nothing to prune, the kernel without band is faster per energy level.
+            # Always float64 profits like the band, the precision does not depend on the width of the band
+            return self.build_matrix_terminal(prices, terminal_values, terminal_decisions, previous_last_action,
+                                              mw_to_mwh_factors, np.float64)
+        cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb = self.get_step_deltas(prices,
+                                                                                                mw_to_mwh_factors)
+        return build_matrix_band(cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb, terminal_values,
+                                 band_low, band_high, int(previous_last_action),
+                                 as_kernel_array(terminal_decisions, np.int8))
+
+    def build_matrix_multigrid(self,
+                               prices: list[float],
+                               initial_energy_lvl: int,
+                               previous_last_action: int,
+                               final_energy_lvl: int,
+                               mw_to_mwh_factors: list[float]):
+        """
+        Create a decision matrix on the fine grid, only in a band around the optimal schedule of a coarse grid.
+        Energy levels are indices of the fine grid.
+        """
+        factor = self.multigrid_factor
+        n_steps = len(prices)
+        cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb = self.get_step_deltas(prices,
+                                                                                                mw_to_mwh_factors)
+
+        # Coarse grid, the changes in energy level are rounded and at least one coarse level
+        n_coarse_levels = (self.n_energy_levels - 1) // factor + 1
+        coarse_delta_pump = np.sign(lvl_delta_pump) * np.maximum(1, np.rint(np.abs(lvl_delta_pump) / factor))
+        coarse_delta_turb = np.sign(lvl_delta_turb) * np.maximum(1, np.rint(np.abs(lvl_delta_turb) / factor))
+        coarse_terminal_values = np.ones(n_coarse_levels) * -np.inf
+        coarse_terminal_values[min(int(round(final_energy_lvl / factor)), n_coarse_levels - 1)] = 0
+        coarse_initial_lvl = min(int(round(initial_energy_lvl / factor)), n_coarse_levels - 1)
+
+        coarse_profits, coarse_decisions = build_matrix_band(cash_delta_pump, cash_delta_turb,
+                                                             coarse_delta_pump.astype(np.int64),
+                                                             coarse_delta_turb.astype(np.int64),
+                                                             coarse_terminal_values,
+                                                             np.zeros(n_steps + 1, dtype=np.int64),
+                                                             np.ones(n_steps + 1, dtype=np.int64) * (n_coarse_levels - 1),
+                                                             int(previous_last_action),
+                                                             np.zeros(n_coarse_levels, dtype=np.int8))
+
+        terminal_values = get_terminal_values(self.n_energy_levels, final_energy_lvl)
+        full_band_low = np.zeros(n_steps + 1, dtype=np.int64)
+        full_band_high = np.ones(n_steps + 1, dtype=np.int64) * (self.n_energy_levels - 1)
+        if (coarse_profits[coarse_initial_lvl] == -np.inf):
+            # No coarse schedule, optimise on the full fine grid
+            return build_matrix_band(cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb,
+                                     terminal_values, full_band_low, full_band_high, int(previous_last_action),
+                                     np.zeros(self.n_energy_levels, dtype=np.int8))
+
+        # Coarse schedule replayed with the fine changes in energy level
+        _, coarse_actions = get_trajectory(coarse_decisions, coarse_initial_lvl,
+                                           coarse_delta_pump.astype(np.int64), coarse_delta_turb.astype(np.int64))
+        fine_deltas = np.where(coarse_actions == 1, -lvl_delta_pump, np.where(coarse_actions == -1, -lvl_delta_turb, 0))
+        center = np.clip(initial_energy_lvl + np.concatenate(([0], np.cumsum(fine_deltas))),
+                         0, self.n_energy_levels - 1)
+
+        band = self.multigrid_band
+        if (band is None):
+            band = 2 * factor * int(max(np.max(np.abs(coarse_delta_pump), initial=1),
+                                        np.max(np.abs(coarse_delta_turb), initial=1)))
+
+        result = None
+        while True:
+            band_low = np.maximum(center - band, 0)
+            band_high = np.minimum(center + band, self.n_energy_levels - 1)
+            band_low[-1] = min(band_low[-1], final_energy_lvl)
+            band_high[-1] = max(band_high[-1], final_energy_lvl)
+            profits, decisions = build_matrix_band(cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb,
+                                                   terminal_values, band_low, band_high, int(previous_last_action),
+                                                   np.zeros(self.n_energy_levels, dtype=np.int8))
+            profit = profits[initial_energy_lvl]
+
+            if (result is not None and self.multigrid_tolerance is not None and result[0][initial_energy_lvl] > -np.inf
+                    and profit - result[0][initial_energy_lvl] <= self.multigrid_tolerance * abs(profit)):
+                return profits, decisions
+            result = (profits, decisions)
+
+            full_band = np.all(band_low == full_band_low) and np.all(band_high == full_band_high)
+            if (full_band):
+                return result
+            if (profit > -np.inf):
+                levels, _ = get_trajectory(decisions, initial_energy_lvl, lvl_delta_pump, lvl_delta_turb)
+                touches_low = (levels == band_low) & (band_low > 0)
+                touches_high = (levels == band_high) & (band_high < self.n_energy_levels - 1)
+                if (not np.any(touches_low | touches_high)):
+                    return result
+            band *= 2
+
+    def calculate_optimal_schedules(self,
+                                    prices,
+                                    initial_energy_lvl: float,
+                                    previous_last_action: int,
+                                    final_energy_lvl: float,
+                                    mw_to_mwh_factors: list[float]):
+        """
+        Optimisation of many price scenarios for the same power plant and the same time steps, in one compiled call.
+        The scenarios are optimised in parallel on all cpus.
+        Same results as calculate_optimal_schedule for each scenario, always with int8 decisions and without
+            multigrid.
+
+        Parameters
+        ----------
+        prices : np.array
+            Prices with one row per scenario and one column per time step.
+        For the other parameters, see documentation of parent class.
+
+        Returns
+        -------
+        dict with the same keys than calculate_optimal_schedule, with one value or row per scenario
+        """
+        total_cashflow, sell_mwh, buy_mwh, hourly_energy_level = optimise_batch(
+            as_kernel_array(prices),
+            int(self.n_energy_levels),
+            int(initial_energy_lvl / self.energy_lvl_step),
+            int(previous_last_action),
+            int(final_energy_lvl / self.energy_lvl_step),
+            as_kernel_array(mw_to_mwh_factors),
+            *self.get_kernel_parameters(),
+            float(self.delta_lvl_pump),
+            float(self.delta_lvl_turb))
+
+        return {
+            'total_cashflow': total_cashflow,
             'sell_mwh': sell_mwh,
             'buy_mwh': buy_mwh,
-            'hourly_energy_level': [lvl * self.energy_lvl_step for lvl in energy_lvl][1:]
+            'hourly_energy_level': hourly_energy_level
         }
- 
+
+    def get_decision_matrix_size(self, n_steps: int):
+        """
+        Size in bytes of the decision matrix for a timeserie of n_steps.
+        """
+        if (self.packed_decisions):
+            return (n_steps + 1) * get_packed_row_size(self.n_energy_levels)
+        return (n_steps + 1) * self.n_energy_levels
+
+    def get_kernel_parameters(self):
+        """
+        Parameters of the power plant for the compiled functions, converted to the types of their signatures.
+        """
+        return (float(self.ppt.get_max_pump_power()),
+                float(self.ppt.get_max_turb_power()),
+                float(self.ppt.get_pump_efficiency()),
+                float(self.energy_lvl_step))
+
     def build_matrix(self,
                      electricity_price: list[float],
                      n_energy_levels: int,
@@ -67,19 +633,343 @@ class DynamicProgrammingOptimisation(IScheduleOptimization):
         """
         Create a decision matrix according to prices.
         """
-        return build_matrix_optimized(electricity_price, 
-                     n_energy_levels, 
-                     previous_last_action, 
-                     final_energy_level, 
-                     mw_to_mwh_factors, 
-                     self.ppt.get_max_pump_power(), 
-                     self.ppt.get_max_turb_power(), 
-                     self.ppt.get_pump_efficiency(), 
-                     self.energy_lvl_step)
+        if ((self.kernel == "gather" or self.value_dtype == np.float32) and not self.packed_decisions):
+            return self.build_matrix_terminal(electricity_price,
+                                              get_terminal_values(n_energy_levels, final_energy_level),
+                                              np.zeros(n_energy_levels, dtype=np.int8),
+                                              previous_last_action,
+                                              mw_to_mwh_factors)
+        build_matrix_function = build_matrix_packed if self.packed_decisions else build_matrix_optimized
+        return build_matrix_function(as_kernel_array(electricity_price),
+                                     int(n_energy_levels),
+                                     int(previous_last_action),
+                                     int(final_energy_level),
+                                     as_kernel_array(mw_to_mwh_factors),
+                                     *self.get_kernel_parameters())
+
+    def build_matrix_terminal(self,
+                              electricity_price: list[float],
+                              terminal_values,
+                              terminal_decisions,
+                              previous_last_action: int,
+                              mw_to_mwh_factors: list[float],
+                              value_dtype=None):
+        """
+        Create a decision matrix according to prices, starting from a profit for each final energy level.
+        value_dtype is the type of the profits, self.value_dtype if None.
+        """
+        if (value_dtype is None):
+            value_dtype = self.value_dtype
+        if (self.packed_decisions):
+            build_matrix_function = build_matrix_terminal_packed
+        elif (self.kernel == "gather"):
+            build_matrix_function = build_matrix_terminal_gather
+        elif (value_dtype == np.float32):
+            profits, decisions = build_matrix_terminal_optimized(as_kernel_array(electricity_price),
+                                                                 as_kernel_array(terminal_values, np.float32),
+                                                                 as_kernel_array(terminal_decisions, np.int8),
+                                                                 int(previous_last_action),
+                                                                 as_kernel_array(mw_to_mwh_factors),
+                                                                 *self.get_kernel_parameters())
+            # The other functions (tails, total cashflow) get float64 profits
+            return profits.astype(np.float64), decisions
+        else:
+            build_matrix_function = build_matrix_terminal_optimized
+        return build_matrix_function(as_kernel_array(electricity_price),
+                                     as_kernel_array(terminal_values),
+                                     as_kernel_array(terminal_decisions, np.int8),
+                                     int(previous_last_action),
+                                     as_kernel_array(mw_to_mwh_factors),
+                                     *self.get_kernel_parameters())
     
 
+@jit(nopython=True, cache=True)
+def get_packed_row_size(n_energy_levels: int):
+    """
+    Number of bytes needed to store one row of decisions with 2 bits per decision.
+    """
+    return (n_energy_levels + 3) // 4
+
+
+@jit(nopython=True, cache=True)
+def pack_decision_row(decisions_row, packed_row):
+    """
+    Store a row of decisions (-1, 0 or 1) in packed_row with 2 bits per decision.
+    The decision is stored as decision + 1, so that it is never negative.
+    """
+    packed_row[:] = 0
+    for lvl in range(len(decisions_row)):
+        packed_row[lvl >> 2] |= (decisions_row[lvl] + 1) << ((lvl & 3) * 2)
+
+
+@jit(nopython=True, cache=True)
+def unpack_decision(packed_decisions, i: int, lvl: int):
+    """
+    Read the decision (-1, 0 or 1) at time step i and energy level lvl from a packed decision matrix.
+    """
+    return np.int8(((packed_decisions[i, lvl >> 2] >> ((lvl & 3) * 2)) & 3) - 1)
+
+
+@jit(nopython=True, cache=True)
+def unpack_decision_row(packed_decisions, i: int, n_energy_levels: int):
+    """
+    Read all decisions (-1, 0 or 1) at time step i from a packed decision matrix.
+    """
+    decisions_row = np.zeros(n_energy_levels, dtype=np.int8)
+    for lvl in range(n_energy_levels):
+        decisions_row[lvl] = unpack_decision(packed_decisions, i, lvl)
+    return decisions_row
+
+
+@jit(nopython=True, cache=True)
+def get_terminal_values(n_energy_levels: int, final_energy_level: int):
+    """
+    Profit at the end of the timeserie, only the final energy level is allowed.
+    """
+    terminal_values = np.ones(n_energy_levels) * -np.inf
+    terminal_values[final_energy_level] = 0
+    return terminal_values
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def calculate_step_buffered(profits_previous,
+                            profits_next,
+                            previous_decisions,
+                            next_decisions,
+                            allowed_to_pump: bool,
+                            allowed_to_turb: bool,
+                            cash_delta_pump: float,
+                            cash_delta_turb: float,
+                            lvl_delta_pump: int,
+                            lvl_delta_turb: int):
+    """
+    One backward step of the dynamic programming, without allocating any array.
+    Fills profits_next and next_decisions from profits_previous and previous_decisions.
+    All the values of profits_next are written, next_decisions must be zero.
+    allowed_to_pump and allowed_to_turb are the restrictions of the last action before the timeserie,
+        False only for the first time step.
+    """
+    n_energy_levels = len(profits_previous)
+
+    # no action
+    for lvl in range(n_energy_levels):
+        profits_next[lvl] = profits_previous[lvl]
+
+    for lvl in range(n_energy_levels):
+        # pump
+        new_level = lvl + lvl_delta_pump
+        if (new_level >= 0 and allowed_to_pump and previous_decisions[lvl] != -1):
+            profit = profits_previous[lvl] + cash_delta_pump
+            if (profit > profits_next[new_level]):
+                profits_next[new_level] = profit
+                next_decisions[new_level] = 1
+
+        # turb
+        new_level = lvl + lvl_delta_turb
+        if (new_level < n_energy_levels and allowed_to_turb and previous_decisions[lvl] != 1):
+            profit = profits_previous[lvl] + cash_delta_turb
+            if (profit > profits_next[new_level]):
+                profits_next[new_level] = profit
+                next_decisions[new_level] = -1
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def calculate_step_deltas(electricity_price,
+                          mw_to_mwh_factors,
+                          pump_power: float,
+                          turb_power: float,
+                          pump_efficiency: float,
+                          energy_lvl_step: float,
+                          cash_delta_pump,
+                          cash_delta_turb,
+                          lvl_delta_pump,
+                          lvl_delta_turb):
+    """
+    Fill the cashflows and the changes in energy level of all the time steps for calculate_step_buffered.
+    """
+    for i in range(len(electricity_price)):
+        cash_delta_pump[i] = -pump_power * mw_to_mwh_factors[i] * electricity_price[i]
+        cash_delta_turb[i] = +turb_power * mw_to_mwh_factors[i] * electricity_price[i]
+        # Change in energy level when goint from future to past
+        lvl_delta_pump[i] = - int(pump_power * pump_efficiency * mw_to_mwh_factors[i] / energy_lvl_step)
+        lvl_delta_turb[i] = + int(turb_power * mw_to_mwh_factors[i] / energy_lvl_step)
+
+
+@jit([BUILD_MATRIX_TERMINAL_SIGNATURE, BUILD_MATRIX_TERMINAL_FLOAT32_SIGNATURE], nopython=True, nogil=True, cache=True)
+def build_matrix_terminal_optimized(electricity_price: list[float],
+            terminal_values,
+            terminal_decisions,
+            previous_last_action: int,
+            mw_to_mwh_factors: list[float],
+            pump_power: float,
+            turb_power: float,
+            pump_efficiency: float,
+            energy_lvl_step: float):
+    """
+    Backward dynamic programming starting from a profit for each energy level at the end of the timeserie.
+    terminal_decisions are the decisions right after the timeserie, used for the last step restrictions.
+    The profits are computed with the type of terminal_values, float64 or float32.
+    The cashflows and the changes in energy level of all the time steps are computed before the backward loop,
+        and the profits of two consecutive time steps are kept in two arrays that are swapped after each step.
+        Nothing is allocated in the backward loop.
+    """
+    n_energy_levels = len(terminal_values)
+    n_steps = len(electricity_price)
+    profits_previous = np.copy(terminal_values)
+    profits_next = np.copy(terminal_values)
+    decisions = np.zeros((n_steps + 1, n_energy_levels), dtype=np.int8)
+    decisions[n_steps] = terminal_decisions
+
+    cash_delta_pump = np.zeros(n_steps, dtype=terminal_values.dtype)
+    cash_delta_turb = np.zeros(n_steps, dtype=terminal_values.dtype)
+    lvl_delta_pump = np.zeros(n_steps, dtype=np.int64)
+    lvl_delta_turb = np.zeros(n_steps, dtype=np.int64)
+    calculate_step_deltas(electricity_price, mw_to_mwh_factors, pump_power, turb_power, pump_efficiency,
+                          energy_lvl_step, cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb)
+
+    # Iterate backwards, next is more in the passt
+    for i in range(n_steps, 0, -1):
+        next_i = i - 1
+        calculate_step_buffered(profits_previous, profits_next, decisions[i], decisions[next_i],
+                                next_i != 0 or previous_last_action != 1,
+                                next_i != 0 or previous_last_action != -1,
+                                cash_delta_pump[next_i], cash_delta_turb[next_i],
+                                lvl_delta_pump[next_i], lvl_delta_turb[next_i])
+        profits_previous, profits_next = profits_next, profits_previous
+
+    return profits_previous, decisions
+
+
+@jit([BUILD_MATRIX_TERMINAL_SIGNATURE], nopython=True, nogil=True, cache=True)
+def build_matrix_terminal_packed(electricity_price: list[float],
+            terminal_values,
+            terminal_decisions,
+            previous_last_action: int,
+            mw_to_mwh_factors: list[float],
+            pump_power: float,
+            turb_power: float,
+            pump_efficiency: float,
+            energy_lvl_step: float):
+    """
+    Same as build_matrix_terminal_optimized, but the decision matrix is packed with 2 bits per decision.
+    Only two unpacked rows of decisions are kept in memory.
+    """
+    n_energy_levels = len(terminal_values)
+    n_steps = len(electricity_price)
+    profits_previous = np.copy(terminal_values)
+    profits_next = np.copy(terminal_values)
+    decisions = np.zeros((n_steps + 1, get_packed_row_size(n_energy_levels)), dtype=np.uint8)
+    previous_decisions = np.copy(terminal_decisions)
+    next_decisions = np.zeros(n_energy_levels, dtype=np.int8)
+    pack_decision_row(previous_decisions, decisions[n_steps])
+    cash_delta_pump = np.zeros(n_steps)
+    cash_delta_turb = np.zeros(n_steps)
+    lvl_delta_pump = np.zeros(n_steps, dtype=np.int64)
+    lvl_delta_turb = np.zeros(n_steps, dtype=np.int64)
+    calculate_step_deltas(electricity_price, mw_to_mwh_factors, pump_power, turb_power, pump_efficiency,
+                          energy_lvl_step, cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb)
+
+    # Iterate backwards, next is more in the passt
+    for i in range(n_steps, 0, -1):
+        next_i = i - 1
+        next_decisions[:] = 0
+        calculate_step_buffered(profits_previous, profits_next, previous_decisions, next_decisions,
+                                next_i != 0 or previous_last_action != 1,
+                                next_i != 0 or previous_last_action != -1,
+                                cash_delta_pump[next_i], cash_delta_turb[next_i],
+                                lvl_delta_pump[next_i], lvl_delta_turb[next_i])
+        pack_decision_row(next_decisions, decisions[next_i])
+        previous_decisions, next_decisions = next_decisions, previous_decisions
+        profits_previous, profits_next = profits_next, profits_previous
+
+    return profits_previous, decisions
+
+
+@jit([BUILD_MATRIX_TERMINAL_SIGNATURE], nopython=True, nogil=True, parallel=True, cache=True)
+def build_matrix_terminal_gather(electricity_price,
+                                 terminal_values,
+                                 terminal_decisions,
+                                 previous_last_action: int,
+                                 mw_to_mwh_factors,
+                                 pump_power: float,
+                                 turb_power: float,
+                                 pump_efficiency: float,
+                                 energy_lvl_step: float):
+    """
+    Same result as build_matrix_terminal_optimized, but each energy level gathers its profit from the
+        energy levels it can reach, instead of scattering its profit to the levels that can reach it.
+    Every energy level only writes to itself, so the energy levels are computed in parallel.
+    """
+    n_energy_levels = len(terminal_values)
+    n_steps = len(electricity_price)
+    profits_previous = np.copy(terminal_values)
+    profits_next = np.copy(terminal_values)
+    decisions = np.zeros((n_steps + 1, n_energy_levels), dtype=np.int8)
+    decisions[n_steps] = terminal_decisions
+
+    # Iterate backwards, next is more in the passt
+    for i in range(n_steps, 0, -1):
+        next_i = i - 1
+        mw_to_mwh_factor = mw_to_mwh_factors[next_i]
+
+        cash_delta_pump = -pump_power * mw_to_mwh_factor * electricity_price[next_i]
+        cash_delta_turb = +turb_power * mw_to_mwh_factor * electricity_price[next_i]
+
+        # Change in energy level when goint from future to past
+        lvl_delta_pump = - int(
+            pump_power * pump_efficiency * mw_to_mwh_factor / energy_lvl_step)
+        lvl_delta_turb = + int(turb_power * mw_to_mwh_factor / energy_lvl_step)
+
+        allowed_to_pump = next_i != 0 or previous_last_action != 1
+        allowed_to_turb = next_i != 0 or previous_last_action != -1
+        # The scatter kernel writes the turbine profit first, except if both come from the same level
+        turb_first = lvl_delta_turb - lvl_delta_pump > 0
+
+        previous_decisions = decisions[i]
+        next_decisions = decisions[next_i]
+
+        for lvl in prange(n_energy_levels):
+            # no action
+            best_profit = profits_previous[lvl]
+            best_decision = 0
+
+            # pump, from lvl to the level pump_lvl in the future
+            pump_lvl = lvl - lvl_delta_pump
+            pump_profit = -np.inf
+            if (pump_lvl < n_energy_levels and allowed_to_pump and previous_decisions[pump_lvl] != -1):
+                pump_profit = profits_previous[pump_lvl] + cash_delta_pump
+
+            # turb, from lvl to the level turb_lvl in the future
+            turb_lvl = lvl - lvl_delta_turb
+            turb_profit = -np.inf
+            if (turb_lvl >= 0 and allowed_to_turb and previous_decisions[turb_lvl] != 1):
+                turb_profit = profits_previous[turb_lvl] + cash_delta_turb
+
+            if (turb_first):
+                if (turb_profit > best_profit):
+                    best_profit = turb_profit
+                    best_decision = -1
+                if (pump_profit > best_profit):
+                    best_profit = pump_profit
+                    best_decision = 1
+            else:
+                if (pump_profit > best_profit):
+                    best_profit = pump_profit
+                    best_decision = 1
+                if (turb_profit > best_profit):
+                    best_profit = turb_profit
+                    best_decision = -1
+
+            profits_next[lvl] = best_profit
+            next_decisions[lvl] = best_decision
+
+        profits_previous, profits_next = profits_next, profits_previous
+
+    return profits_previous, decisions
+
+
 # Remove this line if the function crashes
-@jit(nopython=True)
+@jit([BUILD_MATRIX_SIGNATURE], nopython=True, nogil=True, cache=True)
 def build_matrix_optimized(electricity_price: list[float],
             n_energy_levels: int,
             previous_last_action: int,
@@ -93,60 +983,387 @@ def build_matrix_optimized(electricity_price: list[float],
     Separate function for numba optimization.
     Because of the optimization, the function may not be as readable as other functions.
     Operations are choosen to be as parallel as possible, and outside of inner loops as much as possible.
+    The decisions (-1, 0 or 1) are stored as int8.
     """
-    
+    return build_matrix_terminal_optimized(electricity_price,
+                                           get_terminal_values(n_energy_levels, final_energy_level),
+                                           np.zeros(n_energy_levels, dtype=np.int8),
+                                           previous_last_action,
+                                           mw_to_mwh_factors,
+                                           pump_power,
+                                           turb_power,
+                                           pump_efficiency,
+                                           energy_lvl_step)
+
+
+@jit([BUILD_MATRIX_SIGNATURE], nopython=True, nogil=True, cache=True)
+def build_matrix_packed(electricity_price: list[float],
+            n_energy_levels: int,
+            previous_last_action: int,
+            final_energy_level: int,
+            mw_to_mwh_factors: list[float],
+            pump_power: float,
+            turb_power: float,
+            pump_efficiency: float,
+            energy_lvl_step: float):
+    """
+    Same as build_matrix_optimized, but the decision matrix is packed with 2 bits per decision.
+    """
+    return build_matrix_terminal_packed(electricity_price,
+                                        get_terminal_values(n_energy_levels, final_energy_level),
+                                        np.zeros(n_energy_levels, dtype=np.int8),
+                                        previous_last_action,
+                                        mw_to_mwh_factors,
+                                        pump_power,
+                                        turb_power,
+                                        pump_efficiency,
+                                        energy_lvl_step)
+
+
+@jit([BUILD_MATRIX_BAND_SIGNATURE], nopython=True, nogil=True, cache=True)
+def build_matrix_band(cash_delta_pump,
+                      cash_delta_turb,
+                      lvl_delta_pump,
+                      lvl_delta_turb,
+                      terminal_values,
+                      band_low,
+                      band_high,
+                      previous_last_action: int,
+                      terminal_decisions):
+    """
+    Backward dynamic programming where the energy level at time step i is restricted to band_low[i]..band_high[i].
+    The cashflows and the changes in energy level for each time step are given, see get_step_deltas.
+    Only the energy levels in the band are visited.
+    Same result as build_matrix_terminal_optimized when the band covers all the energy levels.
+    """
+    n_steps = len(cash_delta_pump)
+    n_energy_levels = len(terminal_values)
     profits_previous = np.ones(n_energy_levels) * -np.inf
-    profits_previous[final_energy_level] = 0
     profits_next = np.ones(n_energy_levels) * -np.inf
-    decisions = np.zeros((len(electricity_price) + 1, n_energy_levels))
+    decisions = np.zeros((n_steps + 1, n_energy_levels), dtype=np.int8)
+    decisions[n_steps] = terminal_decisions
+    for lvl in range(band_low[n_steps], band_high[n_steps] + 1):
+        profits_previous[lvl] = terminal_values[lvl]
 
     # Iterate backwards, next is more in the passt
-    for i in range(len(electricity_price), 0, -1):
+    for i in range(n_steps, 0, -1):
         next_i = i - 1
-        mw_to_mwh_factor = mw_to_mwh_factors[next_i]
-
-        cash_delta_pump = -pump_power * mw_to_mwh_factor * electricity_price[next_i]
-        cash_delta_turb = +turb_power * mw_to_mwh_factor * electricity_price[next_i]
-
-        # Change in energy level when goint from future to past
-        lvl_delta_pump = - int(
-            pump_power * pump_efficiency * mw_to_mwh_factor / energy_lvl_step)
-        lvl_delta_turb = + int(turb_power * mw_to_mwh_factor / energy_lvl_step)
-
         previous_decisions = decisions[i]
         next_decisions = decisions[next_i]
+        low = band_low[next_i]
+        high = band_high[next_i]
 
-        profit_next_pump = profits_previous + cash_delta_pump
-        profit_next_turb = profits_previous + cash_delta_turb
+        # profits_next still contains the band of time step i + 1
+        if (i < n_steps):
+            profits_next[band_low[i + 1]:band_high[i + 1] + 1] = -np.inf
 
-        if (next_i == 0):
-            allowed_to_pump = (previous_decisions != -1) & (previous_last_action != 1)
-            allowed_to_turb = (previous_decisions != 1) & (previous_last_action != -1)
-        else:
-            allowed_to_pump = previous_decisions != -1
-            allowed_to_turb = previous_decisions != 1
+        # no action
+        profits_next[low:high + 1] = profits_previous[low:high + 1]
+
+        allowed_to_pump = next_i != 0 or previous_last_action != 1
+        allowed_to_turb = next_i != 0 or previous_last_action != -1
 
-        for lvl in range(n_energy_levels):
+        for lvl in range(band_low[i], band_high[i] + 1):
             # pump
-            new_level = lvl + lvl_delta_pump
-            if (new_level >= 0 and allowed_to_pump[lvl]):
-                if (profit_next_pump[lvl] > profits_next[new_level]):
-                    profits_next[new_level] = profit_next_pump[lvl]
+            new_level = lvl + lvl_delta_pump[next_i]
+            if (new_level >= low and new_level <= high and allowed_to_pump and previous_decisions[lvl] != -1):
+                profit = profits_previous[lvl] + cash_delta_pump[next_i]
+                if (profit > profits_next[new_level]):
+                    profits_next[new_level] = profit
                     next_decisions[new_level] = 1
 
             # turb
-            new_level = lvl + lvl_delta_turb
-            if (new_level < n_energy_levels and allowed_to_turb[lvl]):
-                if (profit_next_turb[lvl] > profits_next[new_level]):
-                    profits_next[new_level] = profit_next_turb[lvl]
+            new_level = lvl + lvl_delta_turb[next_i]
+            if (new_level >= low and new_level <= high and allowed_to_turb and previous_decisions[lvl] != 1):
+                profit = profits_previous[lvl] + cash_delta_turb[next_i]
+                if (profit > profits_next[new_level]):
+                    profits_next[new_level] = profit
                     next_decisions[new_level] = -1
 
-            # no action
-            if (profits_previous[lvl] > profits_next[lvl]):
-                profits_next[lvl] = profits_previous[lvl]
-                next_decisions[lvl] = 0
+        profits_previous, profits_next = profits_next, profits_previous
+
+    return profits_previous, decisions
+
+
+@jit([REACHABLE_BAND_SIGNATURE], nopython=True, nogil=True, cache=True)
+def get_reachable_band(mw_to_mwh_factors,
+                       terminal_values,
+                       initial_energy_level: int,
+                       pump_power: float,
+                       turb_power: float,
+                       pump_efficiency: float,
+                       energy_lvl_step: float):
+    """
+    Lowest and highest energy level index at each time step that is reachable from the initial energy level index
+        and from which an energy level with a finite terminal value is reachable.
+    The changes in energy level are the same as in calculate_step_deltas.
+    With an initial energy level index of -1, every energy level is allowed at the start.
+    The band is empty (band_low > band_high) at the time steps where no schedule is possible.
+    """
+    n_steps = len(mw_to_mwh_factors)
+    n_energy_levels = len(terminal_values)
+    band_low = np.zeros(n_steps + 1, dtype=np.int64)
+    band_high = np.ones(n_steps + 1, dtype=np.int64) * (n_energy_levels - 1)
+    lvl_delta_pump = np.zeros(n_steps, dtype=np.int64)
+    lvl_delta_turb = np.zeros(n_steps, dtype=np.int64)
+    for i in range(n_steps):
+        lvl_delta_pump[i] = - int(pump_power * pump_efficiency * mw_to_mwh_factors[i] / energy_lvl_step)
+        lvl_delta_turb[i] = + int(turb_power * mw_to_mwh_factors[i] / energy_lvl_step)
+
+    # Backward reachability from the finite terminal values
+    low = n_energy_levels
+    high = -1
+    for lvl in range(n_energy_levels):
+        if (terminal_values[lvl] > -np.inf):
+            low = min(low, lvl)
+            high = max(high, lvl)
+    band_low[n_steps] = low
+    band_high[n_steps] = high
+    for i in range(n_steps - 1, -1, -1):
+        band_low[i] = max(band_low[i + 1] + lvl_delta_pump[i], 0)
+        band_high[i] = min(band_high[i + 1] + lvl_delta_turb[i], n_energy_levels - 1)
+
+    # Forward reachability from the initial energy level
+    if (initial_energy_level >= 0):
+        low = initial_energy_level
+        high = initial_energy_level
+        for i in range(n_steps + 1):
+            band_low[i] = max(band_low[i], low)
+            band_high[i] = min(band_high[i], high)
+            if (i < n_steps):
+                low = max(low - lvl_delta_turb[i], 0)
+                high = min(high - lvl_delta_pump[i], n_energy_levels - 1)
+    return band_low, band_high
+
+
+@jit(nopython=True, cache=True)
+def get_trajectory(decisions, initial_energy_level: int, lvl_delta_pump, lvl_delta_turb):
+    """
+    Energy level index at each time step and action of each time step, read from an int8 decision matrix.
+    The changes in energy level are the ones of the backward optimisation, see get_step_deltas.
+    """
+    n_steps = len(lvl_delta_pump)
+    levels = np.zeros(n_steps + 1, dtype=np.int64)
+    actions = np.zeros(n_steps, dtype=np.int8)
+    levels[0] = initial_energy_level
+    for i in range(n_steps):
+        actions[i] = decisions[i, levels[i]]
+        if (actions[i] == 1):
+            levels[i + 1] = levels[i] - lvl_delta_pump[i]
+        elif (actions[i] == -1):
+            levels[i + 1] = levels[i] - lvl_delta_turb[i]
+        else:
+            levels[i + 1] = levels[i]
+    return levels, actions
+
+
+@jit(BACKTRACK_SIGNATURES, nopython=True, nogil=True, cache=True)
+def backtrack_schedule(decisions,
+                       packed: bool,
+                       initial_energy_level: int,
+                       mw_to_mwh_factors,
+                       pump_power: float,
+                       turb_power: float,
+                       delta_lvl_pump: float,
+                       delta_lvl_turb: float,
+                       energy_lvl_step: float):
+    """
+    Walk the decision matrix forward from the initial energy level index.
+    Returns the sold energy, the bought energy, the energy level after each time step
+        and the index of the final energy level.
+    """
+    n_steps = len(mw_to_mwh_factors)
+    sell_mwh = np.zeros(n_steps)
+    buy_mwh = np.zeros(n_steps)
+    energy_level = np.zeros(n_steps)
+
+    lvl = initial_energy_level
+    for i in range(n_steps):
+        if (packed):
+            action = unpack_decision(decisions, i, lvl)
+        else:
+            action = decisions[i, lvl]
+
+        if (action == 1):
+            buy_mwh[i] = pump_power * mw_to_mwh_factors[i]
+            lvl = int(lvl + mw_to_mwh_factors[i] * delta_lvl_pump)
+        elif (action == -1):
+            sell_mwh[i] = turb_power * mw_to_mwh_factors[i]
+            lvl = int(lvl + mw_to_mwh_factors[i] * delta_lvl_turb)
+        energy_level[i] = lvl * energy_lvl_step
+
+    return sell_mwh, buy_mwh, energy_level, lvl
+
+
+@jit([BATCH_SIGNATURE], nopython=True, nogil=True, parallel=True, cache=True)
+def optimise_batch(electricity_prices,
+                   n_energy_levels: int,
+                   initial_energy_level: int,
+                   previous_last_action: int,
+                   final_energy_level: int,
+                   mw_to_mwh_factors,
+                   pump_power: float,
+                   turb_power: float,
+                   pump_efficiency: float,
+                   energy_lvl_step: float,
+                   delta_lvl_pump: float,
+                   delta_lvl_turb: float):
+    """
+    Backward optimisation and backtracking of each price scenario (row of electricity_prices), in parallel.
+    Each thread only keeps the decision matrix of the scenario it is optimising.
+    """
+    n_scenarios, n_steps = electricity_prices.shape
+    total_cashflow = np.zeros(n_scenarios)
+    sell_mwh = np.zeros((n_scenarios, n_steps))
+    buy_mwh = np.zeros((n_scenarios, n_steps))
+    energy_level = np.zeros((n_scenarios, n_steps))
+
+    for s in prange(n_scenarios):
+        profits_previous = get_terminal_values(n_energy_levels, final_energy_level)
+        profits_next = np.copy(profits_previous)
+        decisions = np.zeros((n_steps + 1, n_energy_levels), dtype=np.int8)
+        cash_delta_pump = np.zeros(n_steps)
+        cash_delta_turb = np.zeros(n_steps)
+        lvl_delta_pump = np.zeros(n_steps, dtype=np.int64)
+        lvl_delta_turb = np.zeros(n_steps, dtype=np.int64)
+        calculate_step_deltas(electricity_prices[s], mw_to_mwh_factors, pump_power, turb_power, pump_efficiency,
+                              energy_lvl_step, cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb)
+
+        # Iterate backwards, next is more in the passt
+        for i in range(n_steps, 0, -1):
+            next_i = i - 1
+            calculate_step_buffered(profits_previous, profits_next, decisions[i], decisions[next_i],
+                                    next_i != 0 or previous_last_action != 1,
+                                    next_i != 0 or previous_last_action != -1,
+                                    cash_delta_pump[next_i], cash_delta_turb[next_i],
+                                    lvl_delta_pump[next_i], lvl_delta_turb[next_i])
+            profits_previous, profits_next = profits_next, profits_previous
+        total_cashflow[s] = profits_previous[initial_energy_level]
+
+        sell, buy, level, _ = backtrack_schedule(decisions, False, initial_energy_level, mw_to_mwh_factors,
+                                                 pump_power, turb_power, delta_lvl_pump, delta_lvl_turb,
+                                                 energy_lvl_step)
+        sell_mwh[s] = sell
+        buy_mwh[s] = buy
+        energy_level[s] = level
+
+    return total_cashflow, sell_mwh, buy_mwh, energy_level
+
+
+@jit([CHECKPOINTS_SIGNATURE], nopython=True, nogil=True, cache=True)
+def build_checkpoints(electricity_price,
+                      terminal_values,
+                      terminal_decisions,
+                      previous_last_action: int,
+                      mw_to_mwh_factors,
+                      segment_length: int,
+                      pump_power: float,
+                      turb_power: float,
+                      pump_efficiency: float,
+                      energy_lvl_step: float):
+    """
+    Same backward dynamic programming as build_matrix_terminal_optimized, but only the profits and the decisions
+        at the time steps 0, segment_length, 2 * segment_length, ... and at the end of the timeserie are kept.
+    Row s of the checkpoints is the time step s * segment_length, the last row is the end of the timeserie.
+    Like build_matrix_terminal_optimized, the profits of two consecutive time steps are swapped after each step.
+    """
+    n_steps = len(electricity_price)
+    n_energy_levels = len(terminal_values)
+    n_segments = (n_steps + segment_length - 1) // segment_length
+    checkpoint_profits = np.zeros((n_segments + 1, n_energy_levels))
+    checkpoint_decisions = np.zeros((n_segments + 1, n_energy_levels), dtype=np.int8)
+    checkpoint_profits[n_segments] = terminal_values
+    checkpoint_decisions[n_segments] = terminal_decisions
+
+    profits_previous = np.copy(terminal_values)
+    profits_next = np.copy(terminal_values)
+    previous_decisions = np.copy(terminal_decisions)
+    next_decisions = np.zeros(n_energy_levels, dtype=np.int8)
+    cash_delta_pump = np.zeros(n_steps)
+    cash_delta_turb = np.zeros(n_steps)
+    lvl_delta_pump = np.zeros(n_steps, dtype=np.int64)
+    lvl_delta_turb = np.zeros(n_steps, dtype=np.int64)
+    calculate_step_deltas(electricity_price, mw_to_mwh_factors, pump_power, turb_power, pump_efficiency,
+                          energy_lvl_step, cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb)
+
+    # Iterate backwards, next is more in the passt
+    for i in range(n_steps, 0, -1):
+        next_i = i - 1
+        next_decisions[:] = 0
+        calculate_step_buffered(profits_previous, profits_next, previous_decisions, next_decisions,
+                                next_i != 0 or previous_last_action != 1,
+                                next_i != 0 or previous_last_action != -1,
+                                cash_delta_pump[next_i], cash_delta_turb[next_i],
+                                lvl_delta_pump[next_i], lvl_delta_turb[next_i])
+        previous_decisions, next_decisions = next_decisions, previous_decisions
+        profits_previous, profits_next = profits_next, profits_previous
+        if (next_i % segment_length == 0):
+            checkpoint_profits[next_i // segment_length] = profits_previous
+            checkpoint_decisions[next_i // segment_length] = previous_decisions
+
+    return checkpoint_profits, checkpoint_decisions
+
+
+@jit([BACKTRACK_CHECKPOINTED_SIGNATURE], nopython=True, nogil=True, cache=True)
+def backtrack_checkpointed(checkpoint_profits,
+                           checkpoint_decisions,
+                           electricity_price,
+                           previous_last_action: int,
+                           mw_to_mwh_factors,
+                           segment_length: int,
+                           initial_energy_level: int,
+                           pump_power: float,
+                           turb_power: float,
+                           pump_efficiency: float,
+                           energy_lvl_step: float,
+                           delta_lvl_pump: float,
+                           delta_lvl_turb: float):
+    """
+    Read the schedule from the checkpoints of build_checkpoints, segment by segment from the initial energy level.
+    The decision matrix of each segment is computed again from the checkpoint at its end,
+        only one segment of decisions is kept in memory.
+    Same results as backtrack_schedule on the full decision matrix.
+    """
+    n_steps = len(electricity_price)
+    n_energy_levels = checkpoint_profits.shape[1]
+    n_segments = checkpoint_profits.shape[0] - 1
+    sell_mwh = np.zeros(n_steps)
+    buy_mwh = np.zeros(n_steps)
+    energy_level = np.zeros(n_steps)
+    segment_decisions = np.zeros((segment_length + 1, n_energy_levels), dtype=np.int8)
+    profits_previous = np.zeros(n_energy_levels)
+    profits_next = np.zeros(n_energy_levels)
+    cash_delta_pump = np.zeros(n_steps)
+    cash_delta_turb = np.zeros(n_steps)
+    lvl_delta_pump = np.zeros(n_steps, dtype=np.int64)
+    lvl_delta_turb = np.zeros(n_steps, dtype=np.int64)
+    calculate_step_deltas(electricity_price, mw_to_mwh_factors, pump_power, turb_power, pump_efficiency,
+                          energy_lvl_step, cash_delta_pump, cash_delta_turb, lvl_delta_pump, lvl_delta_turb)
+
+    lvl = initial_energy_level
+    for s in range(n_segments):
+        start = s * segment_length
+        end = min(start + segment_length, n_steps)
+        profits_previous[:] = checkpoint_profits[s + 1]
+        segment_decisions[:] = 0
+        segment_decisions[end - start] = checkpoint_decisions[s + 1]
+
+        # Iterate backwards, next is more in the passt
+        for i in range(end, start, -1):
+            next_i = i - 1
+            calculate_step_buffered(profits_previous, profits_next, segment_decisions[i - start],
+                                    segment_decisions[next_i - start],
+                                    next_i != 0 or previous_last_action != 1,
+                                    next_i != 0 or previous_last_action != -1,
+                                    cash_delta_pump[next_i], cash_delta_turb[next_i],
+                                    lvl_delta_pump[next_i], lvl_delta_turb[next_i])
+            profits_previous, profits_next = profits_next, profits_previous
 
-        decisions[next_i] = next_decisions
-        profits_previous = np.copy(profits_next)
+        sell, buy, level, lvl = backtrack_schedule(segment_decisions, False, lvl, mw_to_mwh_factors[start:end],
+                                                   pump_power, turb_power, delta_lvl_pump, delta_lvl_turb,
+                                                   energy_lvl_step)
+        sell_mwh[start:end] = sell
+        buy_mwh[start:end] = buy
+        energy_level[start:end] = level
 
-    return profits_previous, decisions
\ No newline at end of file
+    return sell_mwh, buy_mwh, energy_level, lvl
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 from scipy.optimize import LinearConstraint, milp, Bounds
 
 from optimize import IScheduleOptimization
@@ -7,12 +8,26 @@ from powerplant import IPumpStoragePlant
 
 class MILPScheduleOptimization(IScheduleOptimization):
     """
-    This don't work anymore, use optimize_dynamic instead. TODO need to be fixed
     Optimisation of the schedule of the pump storage plant using a Mixed Integer Linear Programming.
+    The constraints are sparse matrices, the memory grows linearly with the number of time steps.
+
+    Variables for each time step, in this order:
+        turb : energy sold in MWh
+        pump : energy bought in MWh
+        turb on : 1 if the turbine is on, else 0
+        pump on : 1 if the pump is on, else 0
+        level : energy level in MWh at the end of the time step
     """
 
+    var_count_per_time_step = 5
+    TURB = 0
+    PUMP = 1
+    TURB_ON = 2
+    PUMP_ON = 3
+    LEVEL = 4
+
     def __init__(self, ppt: IPumpStoragePlant):
-        self.ppt = ppt
+        super().__init__(ppt)
 
     def calculate_optimal_schedule(self,
                                    electricity_price: list[float],
@@ -20,194 +35,156 @@ class MILPScheduleOptimization(IScheduleOptimization):
                                    previous_last_action: int,
                                    final_energy_level: float,
                                    mw_to_mwh_factors: list[float]):
-
+        """
+        Optimisation using mixed integer linear programming.
+        For more informations, see documentation of parent class.
+        """
+        electricity_price = np.asarray(electricity_price, dtype=np.float64)
+        mw_to_mwh_factors = np.asarray(mw_to_mwh_factors, dtype=np.float64)
         time_step_count = len(electricity_price)
-        var_count_per_time_step = 5
-        total_variable_count = time_step_count * var_count_per_time_step
+
+        # The final energy level must be reachable with steps of energy_lvl_step from the initial energy level
+        final_energy_level = initial_energy_level + np.round(
+            (final_energy_level - initial_energy_level) / self.energy_lvl_step) * self.energy_lvl_step
 
         # Coefficents, represent value to minimize
-        c = np.array([[-price, price, 0, 0, 0] for price in electricity_price])
-        c = np.reshape(c, (total_variable_count, 1)).flatten()
+        c = np.zeros((time_step_count, self.var_count_per_time_step))
+        c[:, self.TURB] = -electricity_price
+        c[:, self.PUMP] = electricity_price
+        c = c.flatten()
 
         # 0 means continus, 1 means integer
-        integrality = np.array([[0, 0, 1, 1, 0] for i in range(time_step_count)]).flatten()
-
-        # Lower and upper bound are always the same
-        lower_bound = np.zeros(total_variable_count)
-        upper_bound = np.array([[self.ppt.max_turb_power, self.ppt.max_pump_power, 1, 1, self.ppt.max_level] for i in
-                                range(time_step_count)])
-        upper_bound = np.reshape(upper_bound, (total_variable_count, 1)).flatten()
-
-        # Constraints initial energy level
-        constraints = (
-            self.get_constraint_initial_energy_level(initial_energy_level, total_variable_count),
-            self.get_constraint_final_energy_level(final_energy_level, total_variable_count),
-            self.get_constraint_energy_level(time_step_count, var_count_per_time_step),
-            self.get_constraint_energy_level_end(time_step_count, var_count_per_time_step, mw_to_mwh_factors),
-            self.get_constraint_turb_on_off(time_step_count, var_count_per_time_step, mw_to_mwh_factors),
-            self.get_constraint_pump_on_off(time_step_count, var_count_per_time_step, mw_to_mwh_factors),
-            self.get_constraint_pump_turb_same_time(time_step_count, var_count_per_time_step),
-            self.get_constraint_turb_pump_pause(time_step_count, var_count_per_time_step),
-            self.get_constraint_pump_turb_pause(time_step_count, var_count_per_time_step),
-        )
+        integrality = np.zeros((time_step_count, self.var_count_per_time_step))
+        integrality[:, [self.TURB_ON, self.PUMP_ON]] = 1
+        integrality = integrality.flatten()
+
+        # Bounds of each variable
+        lower_bound = np.zeros((time_step_count, self.var_count_per_time_step))
+        upper_bound = np.zeros((time_step_count, self.var_count_per_time_step))
+        upper_bound[:, self.TURB] = self.ppt.get_max_turb_power() * mw_to_mwh_factors
+        upper_bound[:, self.PUMP] = self.ppt.get_max_pump_power() * mw_to_mwh_factors
+        upper_bound[:, [self.TURB_ON, self.PUMP_ON]] = 1
+        upper_bound[:, self.LEVEL] = self.ppt.get_max_level()
+        if (previous_last_action == 1):
+            # No turbine directly after pumping
+            upper_bound[0, self.TURB_ON] = 0
+        elif (previous_last_action == -1):
+            # No pump directly after turbining
+            upper_bound[0, self.PUMP_ON] = 0
+        lower_bound[-1, self.LEVEL] = final_energy_level
+        upper_bound[-1, self.LEVEL] = final_energy_level
+
+        constraints = [
+            self.get_constraint_energy_level(time_step_count, initial_energy_level),
+            self.get_constraint_turb_on_off(time_step_count, mw_to_mwh_factors),
+            self.get_constraint_pump_on_off(time_step_count, mw_to_mwh_factors),
+            self.get_constraint_pump_turb_same_time(time_step_count),
+            self.get_constraint_turb_pump_pause(time_step_count),
+            self.get_constraint_pump_turb_pause(time_step_count),
+        ]
+        constraint = LinearConstraint(sparse.vstack([constraint.A for constraint in constraints], format="csr"),
+                                      np.concatenate([constraint.lb for constraint in constraints]),
+                                      np.concatenate([constraint.ub for constraint in constraints]))
 
         # Solve
-        res = milp(c, constraints=constraints, integrality=integrality, bounds=Bounds(lb=lower_bound, ub=upper_bound))
+        res = milp(c, constraints=constraint, integrality=integrality,
+                   bounds=Bounds(lb=lower_bound.flatten(), ub=upper_bound.flatten()))
+        if (res.x is None):
+            raise RuntimeError("MILP optimisation failed: " + res.message)
 
-        total_cashflow = res.fun
-        decisions = np.reshape(res.x, (time_step_count, var_count_per_time_step))
+        decisions = np.reshape(res.x, (time_step_count, self.var_count_per_time_step))
+        # The solver gives values close to 0 or 1 for integers, compute the exact energies
+        turb_on = np.round(decisions[:, self.TURB_ON])
+        pump_on = np.round(decisions[:, self.PUMP_ON])
 
         return {
-            'total_cashflow': total_cashflow,
-            'sell_mwh': decisions[:, 0],
-            'buy_mwh': decisions[:, 1],
-            'hourly_energy_level': decisions[:, 4]
+            'total_cashflow': -res.fun,
+            'sell_mwh': turb_on * self.ppt.get_max_turb_power() * mw_to_mwh_factors,
+            'buy_mwh': pump_on * self.ppt.get_max_pump_power() * mw_to_mwh_factors,
+            'hourly_energy_level': decisions[:, self.LEVEL]
         }
 
-    def get_constraint_initial_energy_level(self, initial_energy_level, total_variable_count):
-        var_coefficients = np.zeros(total_variable_count)
-        var_coefficients[4] = 1
-        return LinearConstraint(var_coefficients, initial_energy_level, initial_energy_level)
-
-    def get_constraint_final_energy_level(self, end_energy_level, total_variable_count):
-        var_coefficients = np.zeros(total_variable_count)
-        var_coefficients[-1] = 1
-
-        # TODO find a solution to this problem
-        return LinearConstraint(var_coefficients, end_energy_level, end_energy_level + 10 * 0.25)
-
-    def get_constraint_energy_level(self, time_step_count, var_count_per_time_step):
-        var_count = time_step_count * var_count_per_time_step
-        coefficient_model = [
-            -1,  # turb before
-            self.ppt.get_pump_efficiency(),  # pump before
-            0,  # turb on before
-            0,  # pump on before
-            1,  # level before
-            0,  # turb now
-            0,  # pump now
-            0,  # turb on now
-            0,  # pump on now
-            -1  # level now
-        ]
-        var_coefficients = np.zeros((time_step_count - 1, var_count))
-        for i in range(0, time_step_count - 1):
-            var_coefficients[i, i * var_count_per_time_step:(i + 2) * var_count_per_time_step] = coefficient_model
-
-        return LinearConstraint(var_coefficients, np.zeros(time_step_count - 1), np.zeros(time_step_count - 1))
-
-    def get_constraint_energy_level_end(self, time_step_count, var_count_per_time_step, mw_to_mwh_factors):
-        """Prevents the pump storage plant to exceed the maximum energy level, or to go below 0 energy level,
-                during the last time step."""
-        var_count = time_step_count * var_count_per_time_step
-        coefficient_model = [
-            0,  # turb
-            0,  # pump
-            -self.ppt.get_max_turb_power() * mw_to_mwh_factors[-1],  # turb on
-            self.ppt.get_max_pump_power() * mw_to_mwh_factors[-1],  # pump on
-            1  # level
-        ]
-
-        var_coefficients = np.zeros((1, var_count))
-        var_coefficients[0, (time_step_count - 1) * var_count_per_time_step:var_count] = coefficient_model
-
-        energy_level_constraint = LinearConstraint(var_coefficients, 0, self.ppt.get_max_level())
-        return energy_level_constraint
-
-    def get_constraint_turb_on_off(self, time_step_count, var_count_per_time_step, mw_to_mwh_factors):
-        var_count = time_step_count * var_count_per_time_step
-
-        var_coefficients = np.zeros((time_step_count, var_count))
-        for i in range(0, time_step_count):
-            coefficient_model = [
-                -1,  # turb
-                0,  # pump
-                self.ppt.get_max_turb_power() * mw_to_mwh_factors[i],  # turb on
-                0,  # pump on
-                0  # level
-            ]
-            var_coefficients[i, i * var_count_per_time_step:(i + 1) * var_count_per_time_step] = coefficient_model
+    def get_variable_indices(self, time_step_count, variable, first_time_step=0, last_time_step=None):
+        """
+        Indices of a variable in the variable vector, for the time steps first_time_step to last_time_step excluded.
+        """
+        if (last_time_step is None):
+            last_time_step = time_step_count
+        return np.arange(first_time_step, last_time_step) * self.var_count_per_time_step + variable
 
+    def get_constraint_matrix(self, time_step_count, columns_and_coefficients, row_count):
+        """
+        Sparse matrix with row_count rows, row i has the coefficients coefficient[i] at the columns columns[i]
+            for each (columns, coefficients) pair.
+        """
+        rows = np.concatenate([np.arange(row_count) for columns, coefficients in columns_and_coefficients])
+        columns = np.concatenate([columns for columns, coefficients in columns_and_coefficients])
+        coefficients = np.concatenate([np.broadcast_to(coefficients, row_count)
+                                       for columns, coefficients in columns_and_coefficients])
+        return sparse.csr_matrix((coefficients, (rows, columns)),
+                                 shape=(row_count, time_step_count * self.var_count_per_time_step))
+
+    def get_constraint_energy_level(self, time_step_count, initial_energy_level):
+        """
+        level now = level before - turb now + pump efficiency * pump now
+        The level before the first time step is the initial energy level.
+        """
+        var_coefficients = self.get_constraint_matrix(time_step_count, [
+            (self.get_variable_indices(time_step_count, self.LEVEL), 1),
+            (self.get_variable_indices(time_step_count, self.TURB), 1),
+            (self.get_variable_indices(time_step_count, self.PUMP), -self.ppt.get_pump_efficiency()),
+        ], time_step_count)
+        level_before = sparse.csr_matrix((-np.ones(time_step_count - 1),
+                                          (np.arange(1, time_step_count),
+                                           self.get_variable_indices(time_step_count, self.LEVEL, 0,
+                                                                     time_step_count - 1))),
+                                         shape=var_coefficients.shape)
+
+        bounds = np.zeros(time_step_count)
+        bounds[0] = initial_energy_level
+        return LinearConstraint(var_coefficients + level_before, bounds, bounds)
+
+    def get_constraint_turb_on_off(self, time_step_count, mw_to_mwh_factors):
+        """The turbine runs at full power when it is on."""
+        var_coefficients = self.get_constraint_matrix(time_step_count, [
+            (self.get_variable_indices(time_step_count, self.TURB), -1),
+            (self.get_variable_indices(time_step_count, self.TURB_ON),
+             self.ppt.get_max_turb_power() * mw_to_mwh_factors),
+        ], time_step_count)
         return LinearConstraint(var_coefficients, np.zeros(time_step_count), np.zeros(time_step_count))
 
-    def get_constraint_pump_on_off(self, time_step_count, var_count_per_time_step, mw_to_mwh_factors):
-        var_count = time_step_count * var_count_per_time_step
-
-        var_coefficients = np.zeros((time_step_count, var_count))
-        for i in range(0, time_step_count):
-            coefficient_model = [
-                0,  # turb
-                -1,  # pump
-                0,  # turb on
-                self.ppt.get_max_pump_power() * mw_to_mwh_factors[i],  # pump on
-                0  # level
-            ]
-            var_coefficients[i, i * var_count_per_time_step:(i + 1) * var_count_per_time_step] = coefficient_model
-
+    def get_constraint_pump_on_off(self, time_step_count, mw_to_mwh_factors):
+        """The pump runs at full power when it is on."""
+        var_coefficients = self.get_constraint_matrix(time_step_count, [
+            (self.get_variable_indices(time_step_count, self.PUMP), -1),
+            (self.get_variable_indices(time_step_count, self.PUMP_ON),
+             self.ppt.get_max_pump_power() * mw_to_mwh_factors),
+        ], time_step_count)
         return LinearConstraint(var_coefficients, np.zeros(time_step_count), np.zeros(time_step_count))
 
-    def get_constraint_pump_turb_same_time(self, time_step_count, var_count_per_time_step):
+    def get_constraint_pump_turb_same_time(self, time_step_count):
         """
         Forbid to have the pump on and the turbine on at the same time.
         No hydrolic short circuit allowed.
         """
-        var_count = time_step_count * var_count_per_time_step
-        coefficient_model = [
-            0,  # turb
-            0,  # pump
-            1,  # turb on
-            1,  # pump on
-            0,  # level
-        ]
-
-        var_coefficients = np.zeros((time_step_count, var_count))
-        for i in range(0, time_step_count):
-            var_coefficients[i, i * var_count_per_time_step:(i + 1) * var_count_per_time_step] = coefficient_model
-
+        var_coefficients = self.get_constraint_matrix(time_step_count, [
+            (self.get_variable_indices(time_step_count, self.TURB_ON), 1),
+            (self.get_variable_indices(time_step_count, self.PUMP_ON), 1),
+        ], time_step_count)
         return LinearConstraint(var_coefficients, np.zeros(time_step_count), np.ones(time_step_count))
 
-    def get_constraint_turb_pump_pause(self, time_step_count, var_count_per_time_step):
-        """Force a pause between pump on and turb off"""
-        var_count = time_step_count * var_count_per_time_step
-        coefficient_model = [
-            0,  # turb before
-            0,  # pump before
-            1,  # turb on before
-            0,  # pump on before
-            0,  # level before
-
-            0,  # turb now
-            0,  # pump now
-            0,  # turb on now
-            1,  # pump on now
-            0,  # level now
-        ]
-
-        var_coefficients = np.zeros((time_step_count - 1, var_count))
-        for i in range(0, time_step_count - 1):
-            var_coefficients[i, i * var_count_per_time_step:(i + 2) * var_count_per_time_step] = coefficient_model
-
+    def get_constraint_turb_pump_pause(self, time_step_count):
+        """Force a pause between turb on and pump on"""
+        var_coefficients = self.get_constraint_matrix(time_step_count, [
+            (self.get_variable_indices(time_step_count, self.TURB_ON, 0, time_step_count - 1), 1),
+            (self.get_variable_indices(time_step_count, self.PUMP_ON, 1, time_step_count), 1),
+        ], time_step_count - 1)
         return LinearConstraint(var_coefficients, np.zeros(time_step_count - 1), np.ones(time_step_count - 1))
 
-    def get_constraint_pump_turb_pause(self, time_step_count, var_count_per_time_step):
-        """Force a pause between turb on and pump off"""
-        var_count = time_step_count * var_count_per_time_step
-        coefficient_model = [
-            0,  # turb before
-            0,  # pump before
-            0,  # turb on before
-            1,  # pump on before
-            0,  # level before
-
-            0,  # turb now
-            0,  # pump now
-            1,  # turb on now
-            0,  # pump on now
-            0,  # level now
-        ]
-
-        var_coefficients = np.zeros((time_step_count - 1, var_count))
-        for i in range(0, time_step_count - 1):
-            var_coefficients[i, i * var_count_per_time_step:(i + 2) * var_count_per_time_step] = coefficient_model
-
+    def get_constraint_pump_turb_pause(self, time_step_count):
+        """Force a pause between pump on and turb on"""
+        var_coefficients = self.get_constraint_matrix(time_step_count, [
+            (self.get_variable_indices(time_step_count, self.PUMP_ON, 0, time_step_count - 1), 1),
+            (self.get_variable_indices(time_step_count, self.TURB_ON, 1, time_step_count), 1),
+        ], time_step_count - 1)
         return LinearConstraint(var_coefficients, np.zeros(time_step_count - 1), np.ones(time_step_count - 1))
@@ -59,9 +59,9 @@ def plot_day_electricity_price(day_index: int, price_1, price_2, price_3):
     plt.show(block=False)
 
 def plot_market(market):
-    da_daily_cashflow_sum = np.cumsum([np.sum(market.transaction_history_da[d]) for d in market.transaction_history_da])
-    id_1_daily_cashflow_sum = np.cumsum([np.sum(market.transaction_history_id_1[d]) for d in market.transaction_history_id_1])
-    id_2_daily_cashflow_sum = np.cumsum([np.sum(market.transaction_history_id_2[d]) for d in market.transaction_history_id_2])
+    da_daily_cashflow_sum = market.ledger_da.get_cumulative_cashflow()
+    id_1_daily_cashflow_sum = market.ledger_id_1.get_cumulative_cashflow()
+    id_2_daily_cashflow_sum = market.ledger_id_2.get_cumulative_cashflow()
 
     plt.plot(da_daily_cashflow_sum)
     plt.plot(id_1_daily_cashflow_sum)
@@ -102,17 +102,11 @@ def plot_compare_powerplants(power_plant_1, power_plant_2):
     plt.show()
 
 def get_real_and_intrinsic_value(ppt_state, market, time_steps_day = 96):
-    total_transaction_cashflow_day = []
-    total_power_value_day = []
-
+    n_days = int(len(ppt_state.prices)/time_steps_day)
     cashflow_schedule = np.reshape(ppt_state.cashflow_schedule, (-1, time_steps_day))
 
-    for i in range(0, int(len(ppt_state.prices)/time_steps_day)):
-        transaction_sum = np.sum(market.transaction_history_da[str(i)] if str(i) in market.transaction_history_da else 0)
-        transaction_sum += np.sum(market.transaction_history_id_1[str(i)] if str(i) in market.transaction_history_id_1 else 0)
-        transaction_sum += np.sum(market.transaction_history_id_2[str(i)] if str(i) in market.transaction_history_id_2 else 0)
-        total_transaction_cashflow_day.append(transaction_sum)
-        total_power_value_day.append(np.sum(cashflow_schedule[i]))
+    total_transaction_cashflow_day = market.get_daily_cashflow(n_days)
+    total_power_value_day = np.sum(cashflow_schedule[0:n_days], axis=1)
     return total_transaction_cashflow_day, total_power_value_day
 
 def plot_real_and_intrinsic_value(ppt_state, market, time_steps_day = 96):
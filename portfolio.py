@@ -0,0 +1,110 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from market import Market, PumpStoragePlantIRMarketOptimiserNDays
+from optimize_dynamic import DynamicProgrammingOptimisation
+
+
+def aggregate_markets(markets):
+    """
+    Market with the sum of the transactions of the given markets, for each market level, day and time step.
+    """
+    portfolio_market = Market()
+    for name in ('ledger_da', 'ledger_id_1', 'ledger_id_2'):
+        ledgers = [getattr(market, name) for market in markets]
+        histories = [ledger.history for ledger in ledgers if ledger.n_days > 0]
+
+        portfolio_ledger = getattr(portfolio_market, name)
+        if (len(histories) > 0):
+            portfolio_ledger.allocate(max(len(history) for history in histories), histories[0].shape[1])
+            for history in histories:
+                portfolio_ledger.cashflows[0:len(history)] += history
+        portfolio_ledger.n_days = max([ledger.n_days for ledger in ledgers] + [0])
+        portfolio_ledger.total = sum(ledger.total for ledger in ledgers)
+    return portfolio_market
+
+
+def _optimise_plant(market_optimiser):
+    market_optimiser.optimise()
+    return market_optimiser
+
+
+class PumpStoragePlantPortfolioOptimiser:
+    """
+    Intrinsic rolling of a portfolio of pump storage plants on the same prices.
+    Each plant has its own market and rolling optimiser (PumpStoragePlantIRMarketOptimiserNDays),
+        the plants are optimised in parallel and their transactions are added in one portfolio market.
+    """
+
+    def __init__(self, ppts: list, create_optimiser=DynamicProgrammingOptimisation, max_workers=None,
+                 use_processes=False):
+        """
+        Parameters
+        ----------
+        ppts : list of IPumpStoragePlant
+            The pump storage plants of the portfolio
+        create_optimiser : function
+            Creates the schedule optimiser (IScheduleOptimization) of a plant
+        max_workers : int
+            Number of plants optimised at the same time, all the cpus if None.
+        use_processes : bool
+            If False, the plants are optimised in threads: the compiled functions release the GIL,
+                but the python part of the rolling optimisation of each day does not run in parallel.
+            If True, the plants are optimised in processes, the plants and the prices are copied to each process.
+        """
+        self.ppts = ppts
+        self.market_optimisers = [PumpStoragePlantIRMarketOptimiserNDays(ppt, Market(), create_optimiser(ppt))
+                                  for ppt in ppts]
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        # Sum of the transactions of all the plants
+        self.market = Market()
+
+    @property
+    def timehorizon(self):
+        return self.market_optimisers[0].timehorizon
+
+    @timehorizon.setter
+    def timehorizon(self, timehorizon):
+        for market_optimiser in self.market_optimisers:
+            market_optimiser.timehorizon = timehorizon
+
+    def set_prices(self, day_ahead, intraday_1, intraday_2):
+        for market_optimiser in self.market_optimisers:
+            market_optimiser.set_prices(day_ahead, intraday_1, intraday_2)
+
+    def optimise(self):
+        """
+        Optimise all the plants, see PumpStoragePlantIRMarketOptimiserNDays.optimise.
+        The market of each plant is in market_optimisers, the sum of all the plants in market.
+        """
+        if (self.use_processes):
+            executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                           mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        with executor:
+            market_optimisers = list(executor.map(_optimise_plant, self.market_optimisers))
+
+        if (self.use_processes):
+            # The processes optimised copies, give the results back to the plants of the portfolio
+            for ppt, market_optimiser in zip(self.ppts, market_optimisers):
+                ppt.state = market_optimiser.ppt.state
+                ppt.state.ppt = ppt
+                market_optimiser.ppt = ppt
+                market_optimiser.optimiser.ppt = ppt
+            self.market_optimisers = market_optimisers
+
+        self.market = aggregate_markets([market_optimiser.market for market_optimiser in self.market_optimisers])
+
+    @property
+    def executed_schedule(self):
+        """Sum of the executed schedules of all the plants."""
+        return np.sum([ppt.state.executed_schedule for ppt in self.ppts], axis=0)
+
+    @property
+    def cashflow_schedule(self):
+        """Sum of the cashflows of the executed schedules of all the plants."""
+        return np.sum([ppt.state.cashflow_schedule for ppt in self.ppts], axis=0)
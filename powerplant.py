@@ -67,39 +67,144 @@ class PumpStoragePlant(IPumpStoragePlant):
 
 class PumpStoragePlantState:
 
-    def __init__(self, ppt):
+    def __init__(self, ppt, max_days=None):
+        """
+        Parameters
+        ----------
+        ppt : IPumpStoragePlant
+            The pump storage plant
+        max_days : int
+            If given, only the last max_days executed days are kept in memory.
+            Used for long running simulations where the full history is not needed.
+        """
         self.ppt = ppt
-        self.executed_schedule = []
-        self.cashflow_schedule = []
-        self.prices = []
-        self.energy_level = 0
-        self.last_action = 0  # 0 = no action, 1 = pump, -1 turb
-        pass
+        self.max_days = max_days
+        self.clear()
 
     def clear(self):
-        self.executed_schedule = []
-        self.prices = []
+        # Executed days are stored in preallocated buffers of shape (days, time steps of a day)
+        self.executed_schedule_buffer = None
+        self.cashflow_schedule_buffer = None
+        self.prices_buffer = None
+        self.n_executed_days = 0
         self.energy_level = 0
-        self.last_action = 0
+        self.last_action = 0  # 0 = no action, 1 = pump, -1 turb
+
+    def allocate(self, n_days, n_step_day):
+        """
+        Preallocate the buffers for n_days days of n_step_day time steps.
+        Already executed days are kept. With max_days, the buffers always have max_days rows,
+            so the executed days keep their row in the ring buffer.
+        """
+        if (self.max_days is not None):
+            n_days = self.max_days
+        else:
+            n_days = max(n_days, self.n_executed_days)
+
+        buffers = []
+        for buffer in (self.executed_schedule_buffer, self.cashflow_schedule_buffer, self.prices_buffer):
+            new_buffer = np.zeros((n_days, n_step_day))
+            if (buffer is not None):
+                n_kept_days = min(len(buffer), n_days)
+                new_buffer[0:n_kept_days] = buffer[0:n_kept_days]
+            buffers.append(new_buffer)
+        self.executed_schedule_buffer, self.cashflow_schedule_buffer, self.prices_buffer = buffers
 
     def execute_schedule(self, prices, day_index, schedule):
-        self.cashflow_schedule = np.concatenate((self.cashflow_schedule, prices * schedule))
-        self.prices = np.concatenate((self.prices, prices))
+        if (self.executed_schedule_buffer is None):
+            self.allocate(1, len(schedule))
+        elif (self.max_days is None and self.n_executed_days == len(self.executed_schedule_buffer)):
+            # More days than allocated, double the size
+            self.allocate(2 * self.n_executed_days, len(schedule))
 
-        # Multiply negative values with the power plant efficiency
-        schedule[schedule < 0] = schedule[schedule < 0] * self.ppt.pump_efficiency
+        row = self.n_executed_days % len(self.executed_schedule_buffer)
+        self.cashflow_schedule_buffer[row] = prices * schedule
+        self.prices_buffer[row] = prices
 
-        self.executed_schedule = np.concatenate((self.executed_schedule, schedule))
+        # Multiply negative values with the power plant efficiency
+        executed_schedule = self.executed_schedule_buffer[row]
+        executed_schedule[:] = schedule
+        executed_schedule[executed_schedule < 0] = executed_schedule[executed_schedule < 0] * self.ppt.pump_efficiency
 
         # Set last action
-        if (schedule[-1] > 0):
+        if (executed_schedule[-1] > 0):
             self.last_action = -1
-        elif (schedule[-1] < 0):
+        elif (executed_schedule[-1] < 0):
             self.last_action = 1
         else:
             self.last_action = 0
 
-        self.energy_level = -np.sum(self.executed_schedule)
+        self.energy_level -= np.sum(executed_schedule)
+        self.n_executed_days += 1
+
+    def get_history(self, buffer):
+        """
+        Executed days of the buffer in chronological order, as one timeserie.
+        Does not copy the data, except when max_days is used and the buffer is full.
+        """
+        if (buffer is None):
+            return np.zeros(0)
+        if (self.n_executed_days <= len(buffer)):
+            return buffer[0:self.n_executed_days].reshape(-1)
+        first_row = self.n_executed_days % len(buffer)
+        return np.concatenate((buffer[first_row:], buffer[0:first_row])).reshape(-1)
+
+    def get_checkpoint(self):
+        """
+        Everything needed to continue the simulation after the executed days, see set_checkpoint.
+        """
+        checkpoint = {
+            'n_executed_days': self.n_executed_days,
+            'energy_level': self.energy_level,
+            'last_action': self.last_action
+        }
+        for name, buffer in (('executed_schedule', self.executed_schedule_buffer),
+                             ('cashflow_schedule', self.cashflow_schedule_buffer),
+                             ('prices', self.prices_buffer)):
+            if (buffer is None):
+                buffer = np.zeros((0, 0))
+            # Only the rows of executed days, all the rows of a full ring buffer
+            checkpoint[name] = buffer[0:min(self.n_executed_days, len(buffer))]
+        return checkpoint
+
+    def set_checkpoint(self, checkpoint):
+        """
+        Restore the state saved with get_checkpoint.
+        The rows of a ring buffer are saved in their order in the ring, max_days must be the same as when saving.
+        """
+        n_executed_days = int(checkpoint['n_executed_days'])
+        n_saved_days = len(checkpoint['executed_schedule'])
+        if (n_saved_days > 0):
+            n_days = n_executed_days if (self.max_days is None) else min(n_executed_days, self.max_days)
+            if (n_saved_days != n_days):
+                raise ValueError("The checkpoint keeps %i of %i executed days, the state keeps %s days"
+                                 % (n_saved_days, n_executed_days, self.max_days))
+        self.clear()
+        self.n_executed_days = n_executed_days
+        self.energy_level = checkpoint['energy_level'][()]
+        self.last_action = int(checkpoint['last_action'])
+        if (len(checkpoint['executed_schedule']) > 0):
+            self.executed_schedule_buffer = np.array(checkpoint['executed_schedule'], dtype=np.float64)
+            self.cashflow_schedule_buffer = np.array(checkpoint['cashflow_schedule'], dtype=np.float64)
+            self.prices_buffer = np.array(checkpoint['prices'], dtype=np.float64)
+
+    def get_last_day(self, buffer):
+        """
+        Last executed day of the buffer, without copy.
+        """
+        return buffer[(self.n_executed_days - 1) % len(buffer)]
+
+    @property
+    def executed_schedule(self):
+        return self.get_history(self.executed_schedule_buffer)
+
+    @property
+    def cashflow_schedule(self):
+        return self.get_history(self.cashflow_schedule_buffer)
+
+    @property
+    def prices(self):
+        return self.get_history(self.prices_buffer)
 
 
 class PSWLimmern(IPumpStoragePlant):
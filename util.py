@@ -1,11 +1,64 @@
-# mean every i th element in the list
 import numpy as np
 
+# Resampling of timeseries along the last axis, so that a 2-D block of days (one row per day) is resampled at once.
+
+
+def downsample_mean(values, factor: int):
+    """
+    Mean of every factor consecutive values along the last axis.
+    When the length is not a multiple of factor, the last value is the mean of the remaining values.
+
+    Parameters
+    ----------
+    values : np.array
+        Timeserie, or block of timeseries with one timeserie per row.
+    factor : int
+        Number of values averaged together.
+
+    Returns
+    -------
+    np.array with ceil(length / factor) values along the last axis
+    """
+    # Reshape does not copy contiguous arrays
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    n_full = values.shape[-1] // factor
+    head = values[..., 0:n_full * factor].reshape(values.shape[:-1] + (n_full, factor)).mean(axis=-1)
+    if (n_full * factor == values.shape[-1]):
+        return head
+    tail = values[..., n_full * factor:].mean(axis=-1, keepdims=True)
+    return np.concatenate((head, tail), axis=-1)
+
+
+def downsample_sum(values, factor: int):
+    """
+    Sum of every factor consecutive values along the last axis, like downsample_mean.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    group_sizes = np.diff(np.append(np.arange(0, values.shape[-1], factor), values.shape[-1]))
+    return downsample_mean(values, factor) * group_sizes
 
+
+def upsample_repeat(values, factor: int):
+    """
+    Repeat every value factor times along the last axis, for values like prices that stay the same
+        in the shorter time steps.
+    """
+    return np.repeat(np.asarray(values, dtype=np.float64), factor, axis=-1)
+
+
+def upsample_split(values, factor: int):
+    """
+    Split every value in factor equal parts along the last axis, for values like energies that are shared
+        between the shorter time steps.
+    """
+    return np.repeat(np.asarray(values, dtype=np.float64) / factor, factor, axis=-1)
+
+
+# mean every i th element in the list
 def mean_every_i_element_in_list(list, i):
-    return np.array([np.mean(list[j:j + i]) for j in range(0, len(list), i)])
+    return downsample_mean(list, i)
 
 
 # mean every i th element in the list in the list
 def mean_every_i_element_in_list_in_list(list, i):
-    return np.array([mean_every_i_element_in_list(list[j], i) for j in range(0, len(list))])
+    return downsample_mean(list, i)